@@ -1,18 +1,26 @@
 import time
 import os
+import json
+import hmac
+import hashlib
+import heapq
+import socket
+import struct
+import signal
 import threading
+import multiprocessing
+import sys
+from array import array
 import random
-import board
-import busio
 import mysql.connector
 import redis
 import requests
-from digitalio import DigitalInOut, Direction, Pull
-from adafruit_pn532.spi import PN532_SPI
-from smbus2 import SMBus
 from dotenv import load_dotenv
 from datetime import datetime
-from RPLCD.i2c import CharLCD
+
+# Library hardware (board, busio, digitalio, adafruit_pn532, smbus2, RPLCD)
+# di-import di dalam fungsi init_* masing-masing, supaya device yang tidak
+# terpasang tidak membuat seluruh proses crash saat import.
 
 # ==========================================
 # 0. CONFIG & SETUP
@@ -22,19 +30,25 @@ DEBUG_MODE = True
 # Load .env from the specific path used by the web server
 load_dotenv('/var/www/html/.env')
 
+# 'thread' (default): satu proses. 'multiprocess': reader, bus, display dan
+# notifier dijalankan sebagai proses terpisah di bawah supervisor.
+CONTROLLER_MODE = os.getenv('CONTROLLER_MODE', 'thread')
+
 # I2C Setup
-try:
-    i2c_bus = SMBus(1)
+I2C_BUS_NUMBER = 1
+i2c_bus = None
+
+def init_i2c():
+    global i2c_bus
+    from smbus2 import SMBus
+    i2c_bus = SMBus(I2C_BUS_NUMBER)
     if DEBUG_MODE: print("✅ [INIT] I2C Bus Connected")
-except:
-    print("❌ [INIT] I2C Bus NOT FOUND")
 
 # LCD I2C Setup (16x2, Address 0x27)
 lcd = None
 lcd_animation_thread = None
 lcd_animation_running = False
 lcd_lock = threading.Lock()  # Thread lock untuk LCD
-import random
 
 def lcd_sanitize(text):
     """Sanitize text to only include LCD-safe ASCII characters"""
@@ -47,13 +61,14 @@ def lcd_sanitize(text):
             result += " "  # Ganti karakter tidak didukung dengan spasi
     return result
 
-try:
-    lcd = CharLCD(i2c_expander='PCF8574', address=0x27, port=1, cols=16, rows=2, dotsize=8)
-    lcd.clear()
+def init_lcd():
+    global lcd
+    from RPLCD.i2c import CharLCD
+    device = CharLCD(i2c_expander='PCF8574', address=0x27, port=I2C_BUS_NUMBER, cols=16, rows=2, dotsize=8)
+    device.clear()
+    lcd = device
     if DEBUG_MODE: print("[INIT] LCD I2C Connected (0x27)")
-except Exception as e:
-    print(f"[INIT] LCD I2C Error: {e}")
-    lcd = None
+    lcd_show_idle()
 
 def lcd_clear():
     """Clear LCD display"""
@@ -394,11 +409,25 @@ r = redis.Redis(
     decode_responses=True
 )
 
+def init_redis():
+    r.ping()
+    if DEBUG_MODE: print("✅ [INIT] Redis Connected")
+
 # RFID Setup (PN532 SPI)
-spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
-cs_pin = DigitalInOut(board.D5)
-pn532 = PN532_SPI(spi, cs_pin, debug=False)
-pn532.SAM_configuration()
+pn532 = None
+
+def init_rfid():
+    global pn532
+    import board
+    import busio
+    from digitalio import DigitalInOut
+    from adafruit_pn532.spi import PN532_SPI
+    spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
+    cs_pin = DigitalInOut(board.D5)
+    reader = PN532_SPI(spi, cs_pin, debug=False)
+    reader.SAM_configuration()
+    pn532 = reader
+    if DEBUG_MODE: print("✅ [INIT] PN532 RFID Reader Ready")
 
 active_transactions = {}
 transaction_lock = threading.RLock()
@@ -413,34 +442,35 @@ def log(tag, message):
 # Server URL for realtime notifications (change this to your server address)
 SERVER_URL = os.getenv('SERVER_URL', 'http://localhost:8888')
 
+def post_locker_event(payload, session=None):
+    """POST one hardware event to the web server (blocking)"""
+    try:
+        response = (session or requests).post(
+            f"{SERVER_URL}/api/hardware/locker-event",
+            json=payload,
+            timeout=3
+        )
+        if response.status_code == 200:
+            log("REALTIME", f"Event sent: {payload['eventType']} - Locker {payload['lockerId'] or payload['lockerCode']}")
+        else:
+            log("REALTIME", f"Failed to send event: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        log("REALTIME", f"Connection error: {e}")
+    except Exception as e:
+        log("REALTIME", f"Error: {e}")
+
 def send_realtime_notification(event_type, locker_id=None, locker_code=None, user_id=None, user_name=None, action=None):
     """Send realtime notification to web server via HTTP POST (non-blocking)"""
-    def _send():
-        try:
-            payload = {
-                'eventType': event_type,
-                'lockerId': locker_id,
-                'lockerCode': locker_code,
-                'userId': user_id,
-                'userName': user_name,
-                'action': action
-            }
-            response = requests.post(
-                f"{SERVER_URL}/api/hardware/locker-event",
-                json=payload,
-                timeout=3
-            )
-            if response.status_code == 200:
-                log("REALTIME", f"Event sent: {event_type} - Locker {locker_id or locker_code}")
-            else:
-                log("REALTIME", f"Failed to send event: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            log("REALTIME", f"Connection error: {e}")
-        except Exception as e:
-            log("REALTIME", f"Error: {e}")
-    
+    payload = {
+        'eventType': event_type,
+        'lockerId': locker_id,
+        'lockerCode': locker_code,
+        'userId': user_id,
+        'userName': user_name,
+        'action': action
+    }
     # Run in background thread to avoid blocking
-    threading.Thread(target=_send, daemon=True).start()
+    threading.Thread(target=post_locker_event, args=(payload,), daemon=True).start()
 
 # ==========================================
 # 1. HELPER CLASSES & FUNCTIONS
@@ -448,6 +478,7 @@ def send_realtime_notification(event_type, locker_id=None, locker_code=None, use
 
 class MatrixKeypad:
     def __init__(self, rows, cols, keys):
+        from digitalio import DigitalInOut, Direction, Pull
         self.rows = [DigitalInOut(pin) for pin in rows]
         self.cols = [DigitalInOut(pin) for pin in cols]
         self.keys = keys
@@ -479,8 +510,9 @@ class MatrixKeypad:
 # Define Keypad Pins (Adjust to your wiring!)
 # Rows: GPIO 5, 6, 13, 19
 # Cols: GPIO 12, 16, 20, 21
-KEYPAD_ROWS = [board.D21, board.D20, board.D16, board.D12] 
-KEYPAD_COLS = [board.D26, board.D19, board.D13, board.D6]
+# (nama pin 'board', di-resolve saat keypad diinisialisasi)
+KEYPAD_ROWS = ['D21', 'D20', 'D16', 'D12']
+KEYPAD_COLS = ['D26', 'D19', 'D13', 'D6']
 KEYPAD_KEYS = [
     ['1', '2', '3', 'A'],
     ['4', '5', '6', 'B'],
@@ -488,13 +520,15 @@ KEYPAD_KEYS = [
     ['*', '0', '#', 'D']
 ]
 
-# Initialize Keypad
-try:
-    keypad = MatrixKeypad(KEYPAD_ROWS, KEYPAD_COLS, KEYPAD_KEYS)
+keypad = None
+
+def init_keypad():
+    global keypad
+    import board
+    rows = [getattr(board, pin) for pin in KEYPAD_ROWS]
+    cols = [getattr(board, pin) for pin in KEYPAD_COLS]
+    keypad = MatrixKeypad(rows, cols, KEYPAD_KEYS)
     if DEBUG_MODE: print("✅ [INIT] Keypad Initialized")
-except Exception as e:
-    print(f"❌ [INIT] Keypad Error: {e}")
-    keypad = None
 
 def get_db_connection():
     try:
@@ -503,43 +537,1582 @@ def get_db_connection():
         print(f"❌ [DB] Connection Failed: {err}")
         return None
 
-def read_locker_status(locker_code):
-    # ... (existing code kept via context, but we need to ensure this function is preserved if not replacing entire file)
-    # Since I am replacing a block, I should be careful. 
-    # I will assume the previous 'read_locker_status' is preserved if I don't touch it.
-    # WAIT, I am replacing lines 71-284 which includes helper functions and main loop.
-    # I need to re-implement read_locker_status and others or use multi_replace carefully.
-    
-    # RE-IMPLEMENTING read_locker_status and others to be safe as I am replacing a large chunk
-    if locker_code not in LOCKER_MAP: return None
-    target = LOCKER_MAP[locker_code]
+def init_db():
+    conn = mysql.connector.connect(**db_config)
+    conn.close()
+    if DEBUG_MODE: print("✅ [INIT] Database Reachable")
 
+# ==========================================
+# STARTUP ORCHESTRATOR
+# ==========================================
+# Device dan koneksi diinisialisasi paralel (satu thread per komponen).
+# Komponen 'lazy' (LCD, keypad) baru dinyalakan setelah jalur tap siap.
+# Komponen yang gagal dicoba ulang dengan backoff, tanpa menghentikan proses.
+COMPONENT_STATUS_KEY = 'controller_components'
+COMPONENT_RETRY_MIN = 2.0
+COMPONENT_RETRY_MAX = 60.0
+PROCESS_ROLE = 'main'
+
+class Component:
+    def __init__(self, name, init, requires=(), lazy=False):
+        self.name = name
+        self.init = init
+        self.requires = requires
+        self.lazy = lazy
+        self.state = 'pending'   # pending | starting | ready | failed
+        self.error = None
+        self.attempts = 0
+        self.ready_in = None
+        self.ready = threading.Event()
+        self.thread = None
+
+    def snapshot(self):
+        return {'state': self.state, 'error': self.error, 'attempts': self.attempts,
+                'ready_in': self.ready_in, 'lazy': self.lazy}
+
+COMPONENTS = {}
+startup_time = time.time()
+
+def register_component(name, init, requires=(), lazy=False):
+    COMPONENTS[name] = Component(name, init, requires, lazy)
+
+def publish_component_status():
+    if 'redis' in COMPONENTS and not COMPONENTS['redis'].ready.is_set():
+        return
     try:
-        with transaction_lock:
-            raw = i2c_bus.read_byte(target['addr'])
+        r.hset(COMPONENT_STATUS_KEY, mapping={
+            f"{PROCESS_ROLE}:{name}": json.dumps(comp.snapshot()) for name, comp in COMPONENTS.items()
+            if comp.thread is not None
+        })
+    except Exception as e:
+        log("INIT", f"Status publish failed: {e}")
+
+def _run_component(comp):
+    for dep in comp.requires:
+        COMPONENTS[dep].ready.wait()
+
+    delay = COMPONENT_RETRY_MIN
+    while True:
+        comp.state = 'starting'
+        comp.attempts += 1
+        try:
+            comp.init()
+            comp.state = 'ready'
+            comp.error = None
+            comp.ready_in = round(time.time() - startup_time, 2)
+            comp.ready.set()
+            log("INIT", f"{comp.name} ready in {comp.ready_in}s")
+            publish_component_status()
+            return
+        except Exception as e:
+            comp.state = 'failed'
+            comp.error = str(e)
+            print(f"❌ [INIT] {comp.name} failed (attempt {comp.attempts}): {e}")
+            publish_component_status()
+            time.sleep(delay)
+            delay = min(COMPONENT_RETRY_MAX, delay * 2)
+
+def start_components(names, lazy=False):
+    """Start the given components in parallel (only the lazy or only the eager ones)"""
+    for name in names:
+        comp = COMPONENTS[name]
+        if comp.lazy != lazy or comp.thread is not None:
+            continue
+        comp.thread = threading.Thread(target=_run_component, args=(comp,), name=f"init-{name}", daemon=True)
+        comp.thread.start()
+
+def wait_for_components(*names):
+    for name in names:
+        COMPONENTS[name].ready.wait()
 
-        if target['cmd'] == 1 and raw == 20: return -1 
-        if target['cmd'] == 2 and raw == 21: return -1 
+def component_ready(name):
+    return name in COMPONENTS and COMPONENTS[name].ready.is_set()
 
-        if target['cmd'] == 1: 
-            if raw == 4 or raw == 9: return 0 
-            else: return 1 
-        elif target['cmd'] == 2: 
-            if raw == 5 or raw == 9: return 0 
-            else: return 1 
+def readiness_report():
+    return {name: comp.snapshot() for name, comp in COMPONENTS.items()}
 
+# ==========================================
+# I2C BUS HEALTH (Circuit Breaker per Slave)
+# ==========================================
+# Setiap slave (0x08-0x0C) punya circuit breaker sendiri. Slave yang gagal
+# berulang kali "dibuka" (tidak dipoll) selama waktu backoff, lalu diprobe
+# lagi. Loker di slave lain tetap dipoll dengan kecepatan penuh.
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('I2C_BREAKER_THRESHOLD', 3))
+BREAKER_BASE_BACKOFF = float(os.getenv('I2C_BREAKER_BACKOFF', 2.0))
+BREAKER_MAX_BACKOFF = float(os.getenv('I2C_BREAKER_MAX_BACKOFF', 60.0))
+BUS_RECOVERY_COOLDOWN = 10.0
+BUS_HEALTH_KEY = 'i2c_bus_health'
+BUS_HEALTH_PUBLISH_INTERVAL = 5.0
+
+class SlaveBreaker:
+    """Circuit breaker untuk satu alamat slave I2C (closed -> open -> half_open)"""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.total_success = 0
+        self.trips = 0
+        self.retry_at = 0.0
+        self.last_error = None
+        self.last_success_at = None
+        self.last_failure_at = None
+        self.lock = threading.Lock()
+
+    def allow(self, now=None):
+        """Return True jika slave boleh diakses sekarang"""
+        if self.state == 'closed':
+            return True
+        now = now or time.time()
+        with self.lock:
+            if self.state == 'open' and now >= self.retry_at:
+                # Waktu backoff habis: izinkan satu probe, caller lain tetap ditolak
+                self.state = 'half_open'
+                return True
+        return False
+
+    def record_success(self):
+        if self.state != 'closed':
+            log("I2C", f"Slave {hex(self.addr)} recovered (breaker closed)")
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.total_success += 1
+        self.last_success_at = time.time()
+
+    def record_failure(self, error):
+        now = time.time()
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        self.last_error = str(error)
+        self.last_failure_at = now
+
+        if self.state == 'half_open' or self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+            # Exponential backoff berdasarkan jumlah trip berturut-turut
+            backoff = min(BREAKER_MAX_BACKOFF, BREAKER_BASE_BACKOFF * (2 ** self.trips))
+            self.trips += 1
+            self.retry_at = now + backoff
+            if self.state != 'open':
+                print(f"⚠️ [I2C] Slave {hex(self.addr)} breaker OPEN for {backoff:.0f}s: {error}")
+            self.state = 'open'
+
+    def snapshot(self):
+        return {
+            'addr': hex(self.addr),
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'total_failures': self.total_failures,
+            'total_success': self.total_success,
+            'trips': self.trips,
+            'retry_in': max(0, round(self.retry_at - time.time(), 1)) if self.state == 'open' else 0,
+            'last_error': self.last_error,
+            'last_success_at': self.last_success_at,
+        }
+
+slave_breakers = {}
+last_bus_recovery = 0.0
+last_health_publish = 0.0
+
+def get_breaker(addr):
+    breaker = slave_breakers.get(addr)
+    if breaker is None:
+        breaker = slave_breakers[addr] = SlaveBreaker(addr)
+    return breaker
+
+def rebuild_breakers():
+    """Sync breaker table with the slave addresses in LOCKER_MAP"""
+    addrs = {target['addr'] for target in LOCKER_MAP.values()}
+    for addr in addrs:
+        get_breaker(addr)
+    removed = [addr for addr in slave_breakers if addr not in addrs]
+    for addr in removed:
+        del slave_breakers[addr]
+    if removed:
+        try:
+            r.hdel(BUS_HEALTH_KEY, *[hex(addr) for addr in removed])
+        except Exception as e:
+            log("I2C", f"Health cleanup failed: {e}")
+
+def recover_i2c_bus():
+    """Try to recover a stuck bus by reopening the SMBus device"""
+    global i2c_bus, last_bus_recovery
+    now = time.time()
+    if now - last_bus_recovery < BUS_RECOVERY_COOLDOWN:
+        return False
+    last_bus_recovery = now
+
+    from smbus2 import SMBus
+    print("⚠️ [I2C] Bus looks stuck, reopening /dev/i2c-%d" % I2C_BUS_NUMBER)
+    with transaction_lock:
+        try:
+            if i2c_bus:
+                i2c_bus.close()
+        except Exception:
+            pass
+        try:
+            i2c_bus = SMBus(I2C_BUS_NUMBER)
+            log("I2C", "Bus reopened")
+            return True
+        except Exception as e:
+            i2c_bus = None
+            print(f"❌ [I2C] Bus recovery failed: {e}")
+            return False
+
+def bus_looks_stuck():
+    """Bus dianggap macet jika >= 2 slave gagal dan tidak ada slave yang sukses sejak itu"""
+    failing = [b for b in slave_breakers.values() if b.consecutive_failures > 0]
+    if len(failing) < 2:
+        return False
+    last_success = max((b.last_success_at or 0) for b in slave_breakers.values())
+    return last_success < min(b.last_failure_at for b in failing)
+
+def i2c_call(addr, operation, force=False):
+    """
+    Run operation(bus) for a slave under the transaction lock, guarded by its breaker.
+    Returns (ok, result). force=True bypasses an open breaker (user-initiated actions).
+    """
+    breaker = get_breaker(addr)
+    if not force and not breaker.allow():
+        return False, None
+
+    try:
+        if i2c_bus is None:
+            raise IOError("I2C bus not available")
+        with transaction_lock:
+            result = operation(i2c_bus)
+        breaker.record_success()
+        return True, result
     except Exception as e:
-        print(f"❌ [I2C] Read Error {locker_code}: {e}")
+        breaker.record_failure(e)
+        if i2c_bus is None or bus_looks_stuck():
+            recover_i2c_bus()
+        return False, e
+
+def probe_open_slaves():
+    """Probe slaves whose backoff expired, even when no transaction needs them"""
+    now = time.time()
+    for addr, breaker in list(slave_breakers.items()):
+        if breaker.state == 'open' and now >= breaker.retry_at:
+            i2c_call(addr, lambda bus, a=addr: bus.read_byte(a))
+
+def get_bus_health():
+    """Per-slave health report"""
+    return {hex(addr): b.snapshot() for addr, b in sorted(slave_breakers.items())}
+
+def publish_bus_health(force=False):
+    """Write per-slave health to Redis (hash field per slave address)"""
+    global last_health_publish
+    now = time.time()
+    if not force and now - last_health_publish < BUS_HEALTH_PUBLISH_INTERVAL:
+        return
+    last_health_publish = now
+    try:
+        r.hset(BUS_HEALTH_KEY, mapping={k: json.dumps(v) for k, v in get_bus_health().items()})
+    except Exception as e:
+        log("I2C", f"Health publish failed: {e}")
+
+rebuild_breakers()
+
+def decode_status(cmd, raw):
+    """Raw slave byte -> 0 (closed), 1 (open), -1 (stuck) for door A (cmd 1) or B (cmd 2)"""
+    if cmd == 1 and raw == 20: return -1 
+    if cmd == 2 and raw == 21: return -1 
+
+    if cmd == 1: 
+        if raw == 4 or raw == 9: return 0 
+        else: return 1 
+    elif cmd == 2: 
+        if raw == 5 or raw == 9: return 0 
+        else: return 1 
+
+# ==========================================
+# DOOR TELEMETRY (Ring Buffer per Loker)
+# ==========================================
+# Setiap hasil poll disimpan di ring buffer berbasis array (bukan dict):
+# delta waktu (ms, uint32) + byte status mentah (uint8). 512 sampel =
+# 2.5 KB per loker. Byte 255 = slave tidak merespon.
+TELEMETRY_SAMPLES = int(os.getenv('TELEMETRY_SAMPLES', 512))
+TELEMETRY_DIR = os.getenv('TELEMETRY_DIR', '/var/log/smart-locker')
+TELEMETRY_READ_ERROR = 255
+TELEMETRY_STUCK_KEEP = int(os.getenv('TELEMETRY_STUCK_KEEP', 5))   # File bukti stuck per loker
+TELEMETRY_FLAP_WINDOW_MS = 2000   # Buka-tutup-buka lebih cepat dari ini = flapping
+TELEMETRY_MAGIC = b'SLTM'
+TELEMETRY_HEADER = struct.Struct('<4sBBH')        # magic, version, byteorder (0=little), lockers
+TELEMETRY_LOCKER_HEADER = struct.Struct('<8sBId')  # code, cmd, samples, last timestamp
+
+class DoorTelemetry:
+    def __init__(self, size=TELEMETRY_SAMPLES):
+        self.size = size
+        self.deltas = array('I', bytes(4 * size))
+        self.codes = array('B', bytes(size))
+        self.head = 0          # next write position
+        self.count = 0
+        self.last_ms = None    # absolute time of the newest sample (ms)
+
+    def record(self, raw, now=None):
+        now_ms = int((now or time.time()) * 1000)
+        delta = 0 if self.last_ms is None else min(0xFFFFFFFF, max(0, now_ms - self.last_ms))
+        self.deltas[self.head] = delta
+        self.codes[self.head] = raw & 0xFF
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.last_ms = now_ms
+
+    def views(self):
+        """Zero-copy (deltas, codes) memoryview segments in chronological order"""
+        start = (self.head - self.count) % self.size
+        if start + self.count <= self.size:
+            spans = [(start, start + self.count)]
+        else:
+            spans = [(start, self.size), (0, self.head)]
+        dv, cv = memoryview(self.deltas), memoryview(self.codes)
+        return [dv[a:b] for a, b in spans], [cv[a:b] for a, b in spans]
+
+    def samples(self):
+        """Yield (timestamp_ms, raw) oldest first"""
+        delta_views, code_views = self.views()
+        deltas = [d for view in delta_views for d in view]
+        codes = [c for view in code_views for c in view]
+        # Timestamps are rebuilt backwards from the newest sample
+        ts = self.last_ms
+        stamps = []
+        for i in range(len(deltas) - 1, -1, -1):
+            stamps.append(ts)
+            ts -= deltas[i]
+        stamps.reverse()
+        return zip(stamps, codes)
+
+door_telemetry = {}
+telemetry_lock = threading.Lock()
+
+def record_telemetry(locker_code, raw):
+    with telemetry_lock:
+        buf = door_telemetry.get(locker_code)
+        if buf is None:
+            buf = door_telemetry[locker_code] = DoorTelemetry()
+        buf.record(raw)
+
+def telemetry_summary(locker_code):
+    """Open durations, stuck frequency, flapping and read errors for one locker"""
+    with telemetry_lock:
+        buf = door_telemetry.get(locker_code)
+        if buf is None or buf.count == 0:
+            return {'samples': 0}
+        samples = list(buf.samples())
+    cmd = LOCKER_MAP[locker_code]['cmd'] if locker_code in LOCKER_MAP else 1
+
+    open_durations, stuck_runs, flaps, read_errors = [], 0, 0, 0
+    prev_state, open_since, last_close = None, None, None
+    for ts, raw in samples:
+        if raw == TELEMETRY_READ_ERROR:
+            read_errors += 1
+            continue
+        state = decode_status(cmd, raw)
+        if state == prev_state:
+            continue
+        if state == -1:
+            stuck_runs += 1
+        elif state == 1:
+            open_since = ts
+            if last_close is not None and ts - last_close < TELEMETRY_FLAP_WINDOW_MS:
+                flaps += 1
+        elif state == 0:
+            if prev_state == 1 and open_since is not None:
+                open_durations.append((ts - open_since) / 1000.0)
+            last_close = ts
+        prev_state = state
+
+    span = (samples[-1][0] - samples[0][0]) / 1000.0
+    return {
+        'samples': len(samples),
+        'span_seconds': round(span, 1),
+        'opens': len(open_durations),
+        'open_avg_seconds': round(sum(open_durations) / len(open_durations), 1) if open_durations else 0,
+        'open_max_seconds': round(max(open_durations), 1) if open_durations else 0,
+        'stuck_runs': stuck_runs,
+        'stuck_per_hour': round(stuck_runs * 3600 / span, 2) if span > 0 else 0,
+        'flaps': flaps,
+        'read_errors': read_errors,
+    }
+
+def export_telemetry(path, codes=None):
+    """Write ring buffers to a binary file; array memory is written without copying"""
+    with telemetry_lock:
+        selected = [(code, door_telemetry[code]) for code in (codes or sorted(door_telemetry)) if code in door_telemetry]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, 1, 0 if sys.byteorder == 'little' else 1, len(selected)))
+            for code, buf in selected:
+                cmd = LOCKER_MAP[code]['cmd'] if code in LOCKER_MAP else 0
+                f.write(TELEMETRY_LOCKER_HEADER.pack(code.encode()[:8], cmd, buf.count, (buf.last_ms or 0) / 1000.0))
+                delta_views, code_views = buf.views()
+                for view in delta_views:
+                    f.write(view)
+                for view in code_views:
+                    f.write(view)
+    return len(selected)
+
+def read_telemetry_file(path):
+    """Load an export back as {code: {'cmd', 'last_ts', 'deltas': array('I'), 'codes': array('B')}}"""
+    result = {}
+    with open(path, 'rb') as f:
+        magic, _version, order, lockers = TELEMETRY_HEADER.unpack(f.read(TELEMETRY_HEADER.size))
+        if magic != TELEMETRY_MAGIC:
+            raise ValueError(f"{path} is not a telemetry export")
+        for _ in range(lockers):
+            code, cmd, count, last_ts = TELEMETRY_LOCKER_HEADER.unpack(f.read(TELEMETRY_LOCKER_HEADER.size))
+            deltas = array('I')
+            deltas.frombytes(f.read(4 * count))
+            if (order == 0) != (sys.byteorder == 'little'):
+                deltas.byteswap()
+            codes = array('B')
+            codes.frombytes(f.read(count))
+            result[code.rstrip(b'\0').decode()] = {'cmd': cmd, 'last_ts': last_ts, 'deltas': deltas, 'codes': codes}
+    return result
+
+def save_stuck_evidence(locker_code):
+    """Keep the door history of a stuck locker before its transaction is dropped"""
+    summary = telemetry_summary(locker_code)
+    print(f"⚠️ [TELEMETRY] Locker {locker_code} STUCK: {summary}")
+    path = os.path.join(TELEMETRY_DIR, f"stuck-{locker_code}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.bin")
+    try:
+        export_telemetry(path, [locker_code])
+        log("TELEMETRY", f"Evidence saved to {path}")
+        # Keep only the newest TELEMETRY_STUCK_KEEP files per locker (timestamped names sort by age)
+        prefix = f"stuck-{locker_code}-"
+        files = sorted(f for f in os.listdir(TELEMETRY_DIR) if f.startswith(prefix) and f.endswith('.bin'))
+        for name in files[:-TELEMETRY_STUCK_KEEP]:
+            os.remove(os.path.join(TELEMETRY_DIR, name))
+    except OSError as e:
+        log("TELEMETRY", f"Evidence export failed: {e}")
+
+def read_locker_status(locker_code):
+    """Return 0 (closed), 1 (open), -1 (stuck) or None (slave unreachable)"""
+    if locker_code not in LOCKER_MAP: return None
+    target = LOCKER_MAP[locker_code]
+
+    ok, raw = i2c_call(target['addr'], lambda bus: bus.read_byte(target['addr']))
+    if not ok:
+        if raw is not None:
+            record_telemetry(locker_code, TELEMETRY_READ_ERROR)
+            print(f"❌ [I2C] Read Error {locker_code}: {raw}")
         return None
 
+    record_telemetry(locker_code, raw)
+    return decode_status(target['cmd'], raw)
+
 def open_locker_hardware(locker_code):
     target = LOCKER_MAP[locker_code]
+    log("I2C", f"Sending CMD {target['cmd']} to Addr {hex(target['addr'])} ({locker_code})")
+    # Open request always gets one attempt, even if the breaker is open
+    ok, err = i2c_call(target['addr'], lambda bus: bus.write_byte(target['addr'], target['cmd']), force=True)
+    if not ok:
+        print(f"❌ [I2C] Write Error: {err}")
+    return ok
+
+# ==========================================
+# LIVE LOCKER STATE (Redis Snapshot)
+# ==========================================
+# Tabel state ringkas untuk semua loker di LOCKER_MAP. Ditulis ke Redis hanya
+# saat ada perubahan, sehingga dashboard cukup satu HGETALL tanpa query DB.
+# Web server juga menulis (release/takeover) lewat script Lua yang sama, jadi
+# '_version' dinaikkan atomik di Redis oleh siapa pun yang menulis. Snapshot
+# penuh dipublish ulang berkala dari DB + state lokal, sehingga publish yang
+# gagal (Redis restart) atau perubahan dari web tetap terkoreksi.
+LIVE_STATE_KEY = 'locker_live_state'          # Hash: locker_code -> JSON, '_version' -> int
+LIVE_STATE_STREAM = 'locker_state_changes'    # Stream perubahan (dibatasi MAXLEN)
+LIVE_STATE_STREAM_MAXLEN = 1000
+LIVE_STATE_RECONCILE_INTERVAL = float(os.getenv('LIVE_STATE_RECONCILE_INTERVAL', 60))
+
+# KEYS: hash, stream. ARGV: code, state JSON ('null' = remove), stream maxlen
+LIVE_STATE_SET_LUA = """
+local v = redis.call('HINCRBY', KEYS[1], '_version', 1)
+if ARGV[2] == 'null' then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', 'code', ARGV[1], 'version', v, 'state', ARGV[2])
+return v
+"""
+# KEYS: hash. ARGV: code1, state1, code2, state2, ... (replaces every locker field)
+LIVE_STATE_SNAPSHOT_LUA = """
+local v = redis.call('HINCRBY', KEYS[1], '_version', 1)
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if field ~= '_version' then redis.call('HDEL', KEYS[1], field) end
+end
+for i = 1, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return v
+"""
+live_state_set_script = r.register_script(LIVE_STATE_SET_LUA)
+live_state_snapshot_script = r.register_script(LIVE_STATE_SNAPSHOT_LUA)
+
+live_state = {}
+live_state_version = 0
+live_state_lock = threading.Lock()
+live_state_reconciler_started = False
+
+def _empty_locker_state(locker_code):
+    return {
+        'id': LOCKER_MAP[locker_code]['id'],
+        'door': 'closed',       # closed | open | stuck | unknown
+        'user_id': None,
+        'user_name': None,
+        'txn': None,            # booking | release | None
+        'since': int(time.time()),
+    }
+
+def _publish_locker_state(locker_code, payload):
+    """Caller holds live_state_lock, so versions reach Redis in order"""
+    global live_state_version
     try:
-        log("I2C", f"Sending CMD {target['cmd']} to Addr {hex(target['addr'])} ({locker_code})")
-        with transaction_lock:
-            i2c_bus.write_byte(target['addr'], target['cmd'])
+        live_state_version = live_state_set_script(keys=[LIVE_STATE_KEY, LIVE_STATE_STREAM],
+                                                   args=[locker_code, payload, LIVE_STATE_STREAM_MAXLEN])
     except Exception as e:
-        print(f"❌ [I2C] Write Error: {e}")
+        log("STATE", f"Publish failed for {locker_code}: {e}")
+
+def set_locker_state(locker_code, **changes):
+    """Update one locker's live state; publishes to Redis only if something changed"""
+    if locker_code not in LOCKER_MAP:
+        return
+
+    with live_state_lock:
+        current = live_state.get(locker_code) or _empty_locker_state(locker_code)
+        updated = dict(current)
+        updated.update(changes)
+        if updated['door'] != current['door'] or updated['txn'] != current['txn']:
+            updated['since'] = int(time.time())
+        if updated == current and locker_code in live_state:
+            return
+        live_state[locker_code] = updated
+        _publish_locker_state(locker_code, json.dumps(updated, separators=(',', ':')))
+
+def drop_locker_state(codes):
+    """Remove lockers that left LOCKER_MAP from the live state table"""
+    with live_state_lock:
+        for code in codes:
+            live_state.pop(code, None)
+            _publish_locker_state(code, 'null')
+
+def _read_occupants():
+    """locker_code -> (user_id, name) for occupied lockers; None if the DB is down"""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute("""
+            SELECT l.locker_code, l.current_user_id, u.name
+            FROM lockers l LEFT JOIN users u ON l.current_user_id = u.id
+        """)
+        return {row['locker_code']: (row['current_user_id'], row['name'])
+                for row in c.fetchall() if row['current_user_id']}
+    except Exception as e:
+        log("STATE", f"Occupant query failed: {e}")
+        return None
+    finally:
+        conn.close()
+
+def publish_live_snapshot():
+    """Rewrite the whole hash from live_state (caller holds live_state_lock)"""
+    global live_state_version
+    args = []
+    for code, state in live_state.items():
+        args += [code, json.dumps(state, separators=(',', ':'))]
+    live_state_version = live_state_snapshot_script(keys=[LIVE_STATE_KEY], args=args)
+
+def reconcile_live_state():
+    """Take occupants from the DB (web release/takeover) and republish the full snapshot"""
+    occupants = _read_occupants()
+    with transaction_lock:
+        busy = set(active_transactions)
+    with live_state_lock:
+        for code in LOCKER_MAP:
+            state = live_state.setdefault(code, _empty_locker_state(code))
+            if occupants is not None and code not in busy:
+                state['user_id'], state['user_name'] = occupants.get(code, (None, None))
+        publish_live_snapshot()
+
+def _live_state_reconcile_loop():
+    while True:
+        time.sleep(LIVE_STATE_RECONCILE_INTERVAL)
+        try:
+            reconcile_live_state()
+        except Exception as e:
+            log("STATE", f"Reconcile failed: {e}")
+
+def load_live_state():
+    """Seed live state from the lockers table and publish a full snapshot"""
+    global live_state_reconciler_started
+    occupants = _read_occupants() or {}
+    with live_state_lock:
+        live_state.clear()
+        for code in LOCKER_MAP:
+            state = _empty_locker_state(code)
+            state['user_id'], state['user_name'] = occupants.get(code, (None, None))
+            live_state[code] = state
+        try:
+            publish_live_snapshot()
+            log("STATE", f"Live state seeded for {len(LOCKER_MAP)} lockers (v{live_state_version})")
+        except Exception as e:
+            log("STATE", f"Snapshot publish failed: {e}")
+
+    if not live_state_reconciler_started:
+        # Also repairs a failed seed or lost publishes once Redis is back
+        live_state_reconciler_started = True
+        threading.Thread(target=_live_state_reconcile_loop, daemon=True).start()
+
+# ==========================================
+# USAGE AGGREGATES (Redis Counters)
+# ==========================================
+# Counter yang di-update O(1) per event, supaya laporan utilisasi/overtime
+# cukup baca key, tanpa scan tabel locker_usage.
+#   locker_agg:occupied            ZSET  locker_code -> epoch mulai dipakai
+#   locker_agg:occupancy_seconds   HASH  locker_code -> total detik terpakai ('_total')
+#   locker_agg:sessions            HASH  locker_code -> jumlah sesi selesai ('_total')
+#   locker_agg:taps:YYYYMMDD       HASH  'HH' -> tap, 'HH:<booking|release|unknown>' -> tap
+AGG_OCCUPIED_KEY = 'locker_agg:occupied'
+AGG_OCCUPANCY_KEY = 'locker_agg:occupancy_seconds'
+AGG_SESSIONS_KEY = 'locker_agg:sessions'
+AGG_TAPS_PREFIX = 'locker_agg:taps:'
+AGG_TAPS_TTL = 40 * 86400
+AGG_RECONCILE_INTERVAL = float(os.getenv('AGG_RECONCILE_INTERVAL', 60))
+
+aggregates_reconciler_started = False
+
+def record_tap(kind):
+    """Count one tap in the hourly bucket (kind: booking | release | unknown | full)"""
+    now = datetime.fromtimestamp(clock())
+    key = AGG_TAPS_PREFIX + now.strftime('%Y%m%d')
+    hour = now.strftime('%H')
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.hincrby(key, hour, 1)
+        pipe.hincrby(key, f"{hour}:{kind}", 1)
+        pipe.expire(key, AGG_TAPS_TTL)
+        pipe.execute()
+    except Exception as e:
+        log("AGG", f"Tap counter failed: {e}")
+
+def record_booking(locker_code, started_at=None):
+    try:
+        r.zadd(AGG_OCCUPIED_KEY, {locker_code: int(started_at or clock())})
+    except Exception as e:
+        log("AGG", f"Booking counter failed: {e}")
+
+def record_release(locker_code):
+    """Close the occupancy session of a locker; adds its dwell time to the totals"""
+    try:
+        started_at = r.zscore(AGG_OCCUPIED_KEY, locker_code)
+        pipe = r.pipeline(transaction=True)
+        pipe.zrem(AGG_OCCUPIED_KEY, locker_code)
+        if started_at is not None:
+            dwell = max(0, int(clock() - started_at))
+            pipe.hincrby(AGG_OCCUPANCY_KEY, locker_code, dwell)
+            pipe.hincrby(AGG_OCCUPANCY_KEY, '_total', dwell)
+            pipe.hincrby(AGG_SESSIONS_KEY, locker_code, 1)
+            pipe.hincrby(AGG_SESSIONS_KEY, '_total', 1)
+        pipe.execute()
+    except Exception as e:
+        log("AGG", f"Release counter failed: {e}")
+
+def _read_occupied_since():
+    conn = get_db_connection()
+    if not conn:
+        raise IOError("database unavailable")
+    try:
+        c = conn.cursor()
+        c.execute("SELECT locker_code, UNIX_TIMESTAMP(occupied_at) FROM lockers WHERE status = 'occupied' AND occupied_at IS NOT NULL")
+        return {code: int(ts) for code, ts in c.fetchall()}
+    finally:
+        conn.close()
+
+def reconcile_aggregates():
+    """
+    Catch occupancy changes made outside the controller (e.g. admin status
+    changes): sessions still in the set but freed in the DB are closed now,
+    lockers occupied in the DB but missing from the set are added.
+    """
+    occupied = _read_occupied_since()
+    tracked = dict(r.zrange(AGG_OCCUPIED_KEY, 0, -1, withscores=True))
+    for code in tracked:
+        if code not in occupied:
+            record_release(code)
+    missing = {code: ts for code, ts in occupied.items() if code not in tracked}
+    if missing:
+        r.zadd(AGG_OCCUPIED_KEY, missing)
+
+def _aggregates_reconcile_loop():
+    while True:
+        time.sleep(AGG_RECONCILE_INTERVAL)
+        try:
+            reconcile_aggregates()
+        except Exception as e:
+            log("AGG", f"Reconcile failed: {e}")
+
+def load_aggregates():
+    """Rebuild the occupied set from the lockers table (counters themselves are kept)"""
+    global aggregates_reconciler_started
+    occupied = _read_occupied_since()
+
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(AGG_OCCUPIED_KEY)
+    if occupied:
+        pipe.zadd(AGG_OCCUPIED_KEY, occupied)
+    pipe.execute()
+    log("AGG", f"Occupied set seeded ({len(occupied)} lockers)")
+    if not aggregates_reconciler_started:
+        aggregates_reconciler_started = True
+        threading.Thread(target=_aggregates_reconcile_loop, daemon=True).start()
+
+# ==========================================
+# WRITE-BEHIND (Batched DB Writes)
+# ==========================================
+# Hanya perubahan status loker yang ditulis sinkron. Riwayat (INSERT/UPDATE
+# locker_usage) masuk antrian dan di-flush per batch setiap
+# WRITE_BEHIND_INTERVAL detik atau saat antrian mencapai WRITE_BEHIND_BATCH.
+# Setiap operasi dicatat dulu ke journal lokal (fsync dikelompokkan oleh
+# flusher, bukan per tap), dan journal ditulis ulang setelah commit, jadi
+# operasi yang belum di-flush selamat dari crash.
+# Replay setelah crash bersifat idempotent (insert yang sudah ada dilewati,
+# update hanya menyentuh baris terbaru dengan end_time IS NULL).
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', 2.0))
+WRITE_BEHIND_BATCH = int(os.getenv('WRITE_BEHIND_BATCH', 50))
+WRITE_BEHIND_DIR = os.getenv('WRITE_BEHIND_DIR', '/var/lib/smart-locker')
+WRITE_BEHIND_MAX_ATTEMPTS = 10
+
+class WriteBehindQueue:
+    def __init__(self):
+        self.ops = []
+        self.pending_starts = {}   # (user_id, locker_id) -> usage_start op still in the queue
+        self.cond = threading.Condition()
+        self.journal_path = None
+        self.journal = None
+        self.journal_dirty = False
+        self.started = False
+
+    def _open_journal(self):
+        if self.journal is not None or self.journal_path is False:
+            return
+        try:
+            os.makedirs(WRITE_BEHIND_DIR, exist_ok=True)
+            self.journal_path = os.path.join(WRITE_BEHIND_DIR, f"write-behind-{PROCESS_ROLE}.jsonl")
+            self.journal = open(self.journal_path, 'a')
+        except OSError as e:
+            print(f"⚠️ [WB] Journal unavailable, queued writes are not crash-safe: {e}")
+            self.journal_path = False
+
+    def _append_journal(self, op):
+        # No fsync here (enqueue runs on the tap path): the page cache already
+        # survives a process crash, the flusher fsyncs within WRITE_BEHIND_INTERVAL
+        self._open_journal()
+        if self.journal:
+            self.journal.write(json.dumps(op, separators=(',', ':')) + '\n')
+            self.journal.flush()
+            self.journal_dirty = True
+
+    def sync_journal(self):
+        with self.cond:
+            if self.journal and self.journal_dirty:
+                os.fsync(self.journal.fileno())
+                self.journal_dirty = False
+
+    def _rewrite_journal(self):
+        if not self.journal:
+            return
+        tmp = self.journal_path + '.tmp'
+        with open(tmp, 'w') as f:
+            for op in self.ops:
+                f.write(json.dumps(op, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal.close()
+        os.replace(tmp, self.journal_path)
+        self.journal = open(self.journal_path, 'a')
+        self.journal_dirty = False
+
+    def _apply(self, op):
+        key = (op['user_id'], op['locker_id'])
+        if op['op'] == 'usage_end' and key in self.pending_starts:
+            # Booking not flushed yet: fold the release into the same INSERT row
+            start = self.pending_starts.pop(key)
+            start.update(end_time=op['end_time'], duration=op['duration'], notes=op['notes'])
+            return
+        if op['op'] == 'usage_start':
+            self.pending_starts[key] = op
+        self.ops.append(op)
+
+    def enqueue(self, op):
+        with self.cond:
+            self._append_journal(op)
+            self._apply(op)
+            if len(self.ops) >= WRITE_BEHIND_BATCH:
+                self.cond.notify()
+
+    def recover(self):
+        """Reload ops journaled by a previous run (or before the flusher started)"""
+        with self.cond:
+            self._open_journal()
+            if not self.journal:
+                return 0
+            with open(self.journal_path) as f:
+                journaled = [json.loads(line) for line in f if line.strip()]
+            self.ops = []
+            self.pending_starts = {}
+            for op in _drop_existing_starts(journaled):
+                self._apply(op)
+            self._rewrite_journal()
+            return len(self.ops)
+
+    def flush(self):
+        """Write one batch; returns number of ops flushed"""
+        with self.cond:
+            batch = self.ops[:WRITE_BEHIND_BATCH]
+            if not batch:
+                return 0
+            # Releases are applied before bookings within a batch, so cut it
+            # before a release of a booking that is inserted by this same batch
+            started = set()
+            for i, op in enumerate(batch):
+                key = (op['user_id'], op['locker_id'])
+                if op['op'] == 'usage_start':
+                    started.add(key)
+                elif key in started:
+                    batch = batch[:i]
+                    break
+            # Later releases must not fold into rows that are being inserted now
+            for op in batch:
+                if op['op'] == 'usage_start':
+                    self.pending_starts.pop((op['user_id'], op['locker_id']), None)
+
+        try:
+            retry = _flush_usage_batch(batch)
+        except Exception as e:
+            with self.cond:
+                for op in batch:
+                    if op['op'] == 'usage_start' and 'end_time' not in op:
+                        self.pending_starts.setdefault((op['user_id'], op['locker_id']), op)
+            log("WB", f"Flush failed, {len(batch)} ops kept: {e}")
+            return 0
+
+        with self.cond:
+            # Retries keep their place ahead of newer ops for the same locker
+            self.ops[:len(batch)] = retry
+            self._rewrite_journal()
+        return len(batch) - len(retry)
+
+    def run(self):
+        while True:
+            with self.cond:
+                if len(self.ops) < WRITE_BEHIND_BATCH:
+                    self.cond.wait(WRITE_BEHIND_INTERVAL)
+            try:
+                self.sync_journal()
+                while self.flush() >= WRITE_BEHIND_BATCH:
+                    pass
+            except Exception as e:
+                print(f"❌ [WB] Flusher Error: {e}")
+                time.sleep(1)
+
+def _drop_existing_starts(ops):
+    """Skip journaled INSERTs that were committed just before a crash"""
+    starts = [op for op in ops if op['op'] == 'usage_start']
+    if not starts:
+        return ops
+    conn = get_db_connection()
+    if not conn:
+        raise IOError("database unavailable")
+    try:
+        c = conn.cursor()
+        placeholders = ', '.join(['(%s, %s, %s)'] * len(starts))
+        params = [v for op in starts for v in (op['user_id'], op['locker_id'], op['start_time'])]
+        c.execute(f"SELECT user_id, locker_number, DATE_FORMAT(start_time, '%%Y-%%m-%%d %%H:%%i:%%s') FROM locker_usage WHERE (user_id, locker_number, start_time) IN ({placeholders})", params)
+        existing = {(u, l, t) for u, l, t in c.fetchall()}
+    finally:
+        conn.close()
+    return [op for op in ops if op['op'] != 'usage_start' or (op['user_id'], op['locker_id'], op['start_time']) not in existing]
+
+def _flush_usage_batch(batch):
+    """
+    One transaction: one joined UPDATE for releases, then a multi-row INSERT
+    for bookings (a release queued before a rebooking must not close the new row)
+    """
+    starts = [op for op in batch if op['op'] == 'usage_start']
+    ends = [op for op in batch if op['op'] == 'usage_end']
+    conn = get_db_connection()
+    if not conn:
+        raise IOError("database unavailable")
+    retry = []
+    try:
+        c = conn.cursor()
+        if ends:
+            # Only the newest open row per (user, locker), like ORDER BY id DESC LIMIT 1
+            values = ' UNION ALL '.join(['SELECT %s AS user_id, %s AS locker_number, %s AS end_time, %s AS duration, %s AS notes'] * len(ends))
+            params = [v for op in ends for v in (op['user_id'], op['locker_id'], op['end_time'], op['duration'], op['notes'])]
+            c.execute(f"""
+                UPDATE locker_usage lu JOIN (
+                    SELECT MAX(o.id) AS id, v.end_time, v.duration, v.notes
+                    FROM locker_usage o JOIN ({values}) v
+                      ON o.user_id = v.user_id AND o.locker_number = v.locker_number AND o.end_time IS NULL
+                    GROUP BY v.user_id, v.locker_number, v.end_time, v.duration, v.notes
+                ) latest ON lu.id = latest.id
+                SET lu.end_time = latest.end_time, lu.duration_minutes = latest.duration, lu.notes = latest.notes
+            """, params)
+            if c.rowcount < len(ends):
+                # Some bookings are not in the DB yet (e.g. queued by another worker): retry those
+                keys = ', '.join(['(%s, %s, %s)'] * len(ends))
+                params = [v for op in ends for v in (op['user_id'], op['locker_id'], op['end_time'])]
+                c.execute(f"SELECT user_id, locker_number FROM locker_usage WHERE (user_id, locker_number, end_time) IN ({keys})", params)
+                done = set(c.fetchall())
+                for op in ends:
+                    if (op['user_id'], op['locker_id']) in done:
+                        continue
+                    op['attempts'] = op.get('attempts', 0) + 1
+                    if op['attempts'] < WRITE_BEHIND_MAX_ATTEMPTS:
+                        retry.append(op)
+                    else:
+                        print(f"⚠️ [WB] No open usage row for user {op['user_id']} locker {op['locker_id']}, release dropped")
+        if starts:
+            rows = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(starts))
+            params = [v for op in starts for v in (op['user_id'], op['locker_id'], op['start_time'],
+                                                   op.get('end_time'), op.get('duration'), op.get('notes'))]
+            c.execute(f"INSERT INTO locker_usage (user_id, locker_number, start_time, end_time, duration_minutes, notes) VALUES {rows}", params)
+        conn.commit()
+    finally:
+        conn.close()
+    log("WB", f"Flushed {len(starts)} inserts, {len(ends)} updates")
+    return retry
+
+write_behind = WriteBehindQueue()
+
+def load_write_behind():
+    recovered = write_behind.recover()
+    if recovered:
+        log("WB", f"Recovered {recovered} queued writes from journal")
+    if not write_behind.started:
+        write_behind.started = True
+        threading.Thread(target=write_behind.run, daemon=True).start()
+
+def flush_write_behind():
+    """Flush everything queued (used by tools and on shutdown); stops if the DB is down"""
+    if write_behind.started:
+        write_behind.sync_journal()
+        while write_behind.flush():
+            pass
+
+def clock():
+    """Time source for transaction timestamps (workload.py substitutes simulated time)"""
+    return time.time()
+
+def db_now():
+    return datetime.fromtimestamp(clock()).strftime('%Y-%m-%d %H:%M:%S')
+
+# ==========================================
+# LOCKER ALLOCATION (In-Memory Free Index)
+# ==========================================
+# Loker kosong diindeks di memori per alamat slave dan jumlah pemakaian,
+# sehingga pemilihan loker tidak lagi selalu loker kosong pertama (yang
+# membuat solenoid di 0x08 cepat aus). Policy bisa dipilih lewat
+# ALLOCATION_POLICY: least_used (default) | spread | nearest.
+# Indeks di-resync berkala dari tabel lockers, dan booking memakai
+# UPDATE ... AND status = 'available' sehingga indeks yang basi tidak
+# pernah menghasilkan double booking.
+ALLOCATION_POLICY = os.getenv('ALLOCATION_POLICY', 'least_used')
+ALLOCATION_RESYNC_INTERVAL = float(os.getenv('ALLOCATION_RESYNC_INTERVAL', 30))
+ALLOCATION_MAX_ATTEMPTS = 3
+# Urutan jarak dari kiosk (terdekat dulu); default urutan id di LOCKER_MAP
+KIOSK_ORDER = [code.strip() for code in os.getenv('LOCKER_KIOSK_ORDER', '').split(',') if code.strip()]
+
+class FreeLockerIndex:
+    """
+    Free lockers in heaps with lazy deletion: an entry whose locker is no
+    longer free (or whose usage count changed) is skipped when it reaches
+    the top, so picks and updates never scan the whole bank.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.usage = {}          # code -> jumlah booking
+        self.rank = {}           # code -> urutan dari kiosk (dihitung sekali saat load)
+        self.free = set()
+        self.free_by_slave = {}  # addr -> set(code)
+        self.by_usage = []       # heap (usage, id, code)
+        self.by_slave = {}       # addr -> heap (usage, id, code)
+        self.by_rank = []        # heap (rank, code)
+
+    def _usage_entry_valid(self, entry):
+        return entry[-1] in self.free and self.usage.get(entry[-1], 0) == entry[0]
+
+    def _rank_entry_valid(self, entry):
+        return entry[-1] in self.free
+
+    def _push(self, heap, entry, valid):
+        heapq.heappush(heap, entry)
+        if len(heap) > 2 * len(LOCKER_MAP) + 8:
+            # Drop stale entries so heaps stay proportional to the bank size
+            heap[:] = list({e for e in heap if valid(e)})
+            heapq.heapify(heap)
+
+    def _top(self, heap, valid):
+        while heap and not valid(heap[0]):
+            heapq.heappop(heap)
+        return heap[0][-1] if heap else None
+
+    def _add_free(self, code):
+        if code in self.free:
+            return
+        addr = LOCKER_MAP[code]['addr']
+        entry = (self.usage.get(code, 0), LOCKER_MAP[code]['id'], code)
+        self.free.add(code)
+        self.free_by_slave.setdefault(addr, set()).add(code)
+        self._push(self.by_usage, entry, self._usage_entry_valid)
+        self._push(self.by_slave.setdefault(addr, []), entry, self._usage_entry_valid)
+        self._push(self.by_rank, (self.rank.get(code, len(self.rank)), code), self._rank_entry_valid)
+
+    def _remove_free(self, code):
+        if code not in self.free:
+            return
+        self.free.discard(code)
+        self.free_by_slave[LOCKER_MAP[code]['addr']].discard(code)
+
+    def load(self, statuses, usage):
+        """Rebuild from {code: status} and {code: usage_count}"""
+        with self.lock:
+            self.usage = {code: usage.get(code, 0) for code in LOCKER_MAP}
+            kiosk = {code: i for i, code in enumerate(KIOSK_ORDER)}
+            order = sorted(LOCKER_MAP, key=lambda code: (kiosk.get(code, len(kiosk)), LOCKER_MAP[code]['id']))
+            self.rank = {code: i for i, code in enumerate(order)}
+            self.free = set()
+            self.free_by_slave = {}
+            self.by_usage = []
+            self.by_slave = {}
+            self.by_rank = []
+            for code in LOCKER_MAP:
+                if statuses.get(code) == 'available':
+                    self._add_free(code)
+            self.loaded = True
+
+    def sync_statuses(self, statuses):
+        with self.lock:
+            for code in LOCKER_MAP:
+                if statuses.get(code) == 'available':
+                    self._add_free(code)
+                else:
+                    self._remove_free(code)
+
+    def pick(self, policy=None):
+        with self.lock:
+            if not self.free:
+                return None
+            chooser = ALLOCATION_POLICIES.get(policy or ALLOCATION_POLICY, policy_least_used)
+            return chooser(self)
+
+    def mark_occupied(self, code, booked=False):
+        with self.lock:
+            self._remove_free(code)
+            if booked:
+                self.usage[code] = self.usage.get(code, 0) + 1
+
+    def mark_free(self, code):
+        with self.lock:
+            if code in LOCKER_MAP:
+                self._add_free(code)
+
+    def least_used(self, addr=None):
+        """Free locker with the fewest bookings (lowest id on ties), optionally on one slave"""
+        heap = self.by_usage if addr is None else self.by_slave.get(addr, [])
+        return self._top(heap, self._usage_entry_valid)
+
+    def nearest(self):
+        return self._top(self.by_rank, self._rank_entry_valid)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'policy': ALLOCATION_POLICY,
+                'free': len(self.free),
+                'free_by_slave': {hex(addr): len(codes) for addr, codes in self.free_by_slave.items()},
+                'usage': dict(self.usage),
+            }
+
+def policy_least_used(index):
+    """Free locker with the fewest bookings (wear levelling)"""
+    return index.least_used()
+
+def policy_spread(index):
+    """Least-used locker on the slave with the most free lockers (spreads load and power draw)"""
+    candidates = {addr: index.least_used(addr) for addr, codes in index.free_by_slave.items() if codes}
+    addr = max(candidates, key=lambda a: (len(index.free_by_slave[a]), -index.usage.get(candidates[a], 0), -a))
+    return candidates[addr]
+
+def policy_nearest(index):
+    """Free locker closest to the kiosk (LOCKER_KIOSK_ORDER, then id order)"""
+    return index.nearest()
+
+ALLOCATION_POLICIES = {
+    'least_used': policy_least_used,
+    'spread': policy_spread,
+    'nearest': policy_nearest,
+}
+
+free_index = FreeLockerIndex()
+
+def _read_locker_statuses(cursor):
+    by_id = {t['id']: code for code, t in LOCKER_MAP.items()}
+    cursor.execute("SELECT id, status FROM lockers")
+    statuses = {}
+    for row in cursor.fetchall():
+        locker_id, status = (row['id'], row['status']) if isinstance(row, dict) else row
+        if locker_id in by_id:
+            statuses[by_id[locker_id]] = status
+    return statuses
+
+def resync_free_index():
+    """Pick up status changes made outside this process (web admin, other workers)"""
+    if not free_index.loaded:
+        return
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        free_index.sync_statuses(_read_locker_statuses(conn.cursor()))
+    finally:
+        conn.close()
+
+def _free_index_resync_loop():
+    while True:
+        time.sleep(ALLOCATION_RESYNC_INTERVAL)
+        try:
+            resync_free_index()
+        except Exception as e:
+            log("ALLOC", f"Resync failed: {e}")
+
+def load_free_index():
+    conn = get_db_connection()
+    if not conn:
+        raise IOError("database unavailable")
+    try:
+        c = conn.cursor()
+        statuses = _read_locker_statuses(c)
+        by_id = {t['id']: code for code, t in LOCKER_MAP.items()}
+        c.execute("SELECT locker_number, COUNT(*) FROM locker_usage GROUP BY locker_number")
+        usage = {by_id[locker_id]: count for locker_id, count in c.fetchall() if locker_id in by_id}
+    finally:
+        conn.close()
+
+    first_load = not free_index.loaded
+    free_index.load(statuses, usage)
+    if first_load:
+        threading.Thread(target=_free_index_resync_loop, daemon=True).start()
+    log("ALLOC", f"Free index loaded: {len(free_index.free)} free, policy {ALLOCATION_POLICY}")
+
+# ==========================================
+# REMOTE COMMANDS (Redis Streams)
+# ==========================================
+# Web server mengirim perintah admin lewat stream 'locker_commands'. Dibaca
+# dengan consumer group (at-least-once); idempotency_key mencegah perintah
+# yang dikirim ulang dieksekusi dua kali.
+COMMAND_STREAM = 'locker_commands'
+COMMAND_GROUP = 'controller'
+COMMAND_CONSUMER = os.getenv('COMMAND_CONSUMER', f"pi-{os.uname().nodename}")
+COMMAND_RESULT_STREAM = 'locker_command_results'
+COMMAND_RESULT_PREFIX = 'locker_cmd:'
+COMMAND_RESULT_TTL = 86400
+COMMAND_BATCH_SIZE = 20
+COMMAND_CLAIM_IDLE_MS = 60000
+COMMAND_OPEN_INTERVAL = 0.3   # Jeda antar solenoid saat buka banyak loker
+LOCKER_MAP_FILE = os.getenv('LOCKER_MAP_FILE')
+
+def _codes_for_args(args):
+    """Resolve 'code', 'codes' or an id range ('from'/'to') to locker codes"""
+    if 'code' in args:
+        codes = [args['code']]
+    elif 'codes' in args:
+        codes = list(args['codes'])
+    elif 'from' in args and 'to' in args:
+        lo, hi = int(args['from']), int(args['to'])
+        codes = [code for code, t in sorted(LOCKER_MAP.items(), key=lambda kv: kv[1]['id']) if lo <= t['id'] <= hi]
+    else:
+        raise ValueError("missing 'code', 'codes' or 'from'/'to'")
+    unknown = [code for code in codes if code not in LOCKER_MAP]
+    if unknown:
+        raise ValueError(f"unknown locker(s): {', '.join(unknown)}")
+    return codes
+
+def _remote_open(code):
+    with transaction_lock:
+        if code in active_transactions:
+            # Door is already being tracked for a user transaction
+            opened = open_locker_hardware(code)
+            return opened
+        active_transactions[code] = {'user_id': None, 'start_time': clock(), 'type': 'admin', 'user_name': None}
+    opened = open_locker_hardware(code)
+    if opened:
+        set_locker_state(code, door='open', txn='admin')
+    else:
+        with transaction_lock: active_transactions.pop(code, None)
+    return opened
+
+def cmd_open_locker(args):
+    code = _codes_for_args(args)[0]
+    if not _remote_open(code):
+        raise IOError(f"I2C write failed for {code}")
+    return {'opened': [code]}
+
+def cmd_open_range(args):
+    opened, failed = [], []
+    for code in _codes_for_args(args):
+        (opened if _remote_open(code) else failed).append(code)
+        time.sleep(COMMAND_OPEN_INTERVAL)
+    return {'opened': opened, 'failed': failed}
+
+def cmd_set_maintenance(args):
+    codes = _codes_for_args(args)
+    enabled = str(args.get('enabled', True)).lower() not in ('0', 'false', 'no')
+    ids = [LOCKER_MAP[code]['id'] for code in codes]
+    conn = get_db_connection()
+    if not conn:
+        raise IOError("database unavailable")
+    try:
+        c = conn.cursor()
+        placeholders = ', '.join(['%s'] * len(ids))
+        if enabled:
+            c.execute(f"UPDATE lockers SET status = 'maintenance' WHERE id IN ({placeholders}) AND status = 'available'", ids)
+        else:
+            c.execute(f"UPDATE lockers SET status = 'available' WHERE id IN ({placeholders}) AND status = 'maintenance'", ids)
+        changed = c.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    resync_free_index()
+    return {'lockers': codes, 'maintenance': enabled, 'changed': changed}
+
+def read_locker_map_file():
+    if not LOCKER_MAP_FILE:
+        raise ValueError("no map file (set LOCKER_MAP_FILE)")
+    with open(LOCKER_MAP_FILE) as f:
+        raw = json.load(f)
+    new_map = {}
+    for code, t in raw.items():
+        addr = int(t['addr'], 0) if isinstance(t['addr'], str) else int(t['addr'])
+        new_map[code] = {'addr': addr, 'cmd': int(t['cmd']), 'id': int(t['id'])}
+    return new_map
+
+def apply_locker_map(new_map):
+    """Swap LOCKER_MAP and rebuild this process's per-locker tables. Returns removed codes."""
+    with transaction_lock:
+        removed = [code for code in LOCKER_MAP if code not in new_map]
+        busy = [code for code in removed if code in active_transactions]
+        if busy:
+            raise ValueError(f"locker(s) with open transactions would be removed: {', '.join(busy)}")
+        LOCKER_MAP.clear()
+        LOCKER_MAP.update(new_map)
+    with telemetry_lock:
+        for code in removed:
+            door_telemetry.pop(code, None)
+    rebuild_breakers()
+    if free_index.loaded:
+        load_free_index()
+    return removed
+
+def cmd_reload_map(args):
+    # Hanya file dari konfigurasi controller, bukan path kiriman web
+    if 'path' in args:
+        raise ValueError("'path' is not accepted, the map is read from LOCKER_MAP_FILE")
+    new_map = read_locker_map_file()
+    removed = apply_locker_map(new_map)
+    drop_locker_state(removed)
+    for code in new_map:
+        set_locker_state(code)
+    if reader_channel:
+        # Multiprocess: the reader books from its own copy of the map
+        reader_channel.send(pack_msg(MSG_RELOAD_MAP))
+    log("CMD", f"LOCKER_MAP reloaded from {LOCKER_MAP_FILE} ({len(new_map)} lockers, {len(removed)} removed)")
+    return {'lockers': len(new_map), 'removed': removed}
+
+def cmd_telemetry(args):
+    codes = _codes_for_args(args) if any(k in args for k in ('code', 'codes', 'from')) else sorted(door_telemetry)
+    result = {'summary': {code: telemetry_summary(code) for code in codes}}
+    if args.get('export'):
+        path = os.path.join(TELEMETRY_DIR, f"telemetry-{datetime.now().strftime('%Y%m%d-%H%M%S')}.bin")
+        result['exported'] = export_telemetry(path, codes)
+        result['path'] = path
+    return result
+
+COMMAND_HANDLERS = {
+    'open_locker': cmd_open_locker,
+    'open_range': cmd_open_range,
+    'set_maintenance': cmd_set_maintenance,
+    'reload_map': cmd_reload_map,
+    'telemetry': cmd_telemetry,
+}
+
+def _publish_command_result(msg_id, key, command, status, result):
+    payload = json.dumps(result, separators=(',', ':'))
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(COMMAND_RESULT_PREFIX + key, mapping={'status': status, 'result': payload, 'message_id': msg_id, 'finished_at': int(time.time())})
+    pipe.expire(COMMAND_RESULT_PREFIX + key, COMMAND_RESULT_TTL)
+    pipe.xadd(COMMAND_RESULT_STREAM, {'key': key, 'command': command, 'status': status, 'result': payload},
+              maxlen=1000, approximate=True)
+    pipe.xack(COMMAND_STREAM, COMMAND_GROUP, msg_id)
+    pipe.execute()
+
+def handle_command(msg_id, fields):
+    command = fields.get('command', '')
+    key = fields.get('idempotency_key') or msg_id
+
+    previous = r.hget(COMMAND_RESULT_PREFIX + key, 'status')
+    if previous in ('ok', 'error'):
+        # Redelivered or resent: don't execute twice, just ack again
+        log("CMD", f"Duplicate command {command} ({key}) skipped")
+        r.xack(COMMAND_STREAM, COMMAND_GROUP, msg_id)
+        return
+
+    r.hset(COMMAND_RESULT_PREFIX + key, mapping={'status': 'running', 'message_id': msg_id})
+    r.expire(COMMAND_RESULT_PREFIX + key, COMMAND_RESULT_TTL)
+
+    handler = COMMAND_HANDLERS.get(command)
+    try:
+        if not handler:
+            raise ValueError(f"unknown command '{command}'")
+        args = json.loads(fields.get('args') or '{}')
+        log("CMD", f"Executing {command} {args} ({key})")
+        status, result = 'ok', handler(args)
+    except Exception as e:
+        print(f"❌ [CMD] {command} failed: {e}")
+        status, result = 'error', {'error': str(e)}
+
+    _publish_command_result(msg_id, key, command, status, result)
+
+def _ensure_command_group():
+    try:
+        r.xgroup_create(COMMAND_STREAM, COMMAND_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def command_consumer():
+    """Drain the command stream in batches; own pending entries first, then new ones"""
+    log("CMD", f"Command consumer started ({COMMAND_CONSUMER})")
+    group_ready = False
+    read_id = '0'   # '0' = redeliver our own unacked entries after a restart
+    last_claim = 0.0
+    while True:
+        try:
+            if not group_ready:
+                _ensure_command_group()
+                group_ready = True
+
+            # Take over entries left pending by a dead consumer
+            if time.time() - last_claim > COMMAND_CLAIM_IDLE_MS / 1000:
+                last_claim = time.time()
+                try:
+                    r.xautoclaim(COMMAND_STREAM, COMMAND_GROUP, COMMAND_CONSUMER,
+                                 min_idle_time=COMMAND_CLAIM_IDLE_MS, start_id='0-0', count=COMMAND_BATCH_SIZE)
+                    read_id = '0'
+                except redis.exceptions.ResponseError:
+                    pass
+
+            response = r.xreadgroup(COMMAND_GROUP, COMMAND_CONSUMER, {COMMAND_STREAM: read_id},
+                                    count=COMMAND_BATCH_SIZE, block=None if read_id == '0' else 2000)
+            entries = response[0][1] if response else []
+
+            if read_id == '0' and not entries:
+                read_id = '>'
+                continue
+
+            for msg_id, fields in entries:
+                if fields is None:
+                    # Entry was trimmed from the stream while pending
+                    r.xack(COMMAND_STREAM, COMMAND_GROUP, msg_id)
+                    continue
+                handle_command(msg_id, fields)
+
+        except redis.exceptions.ConnectionError as e:
+            log("CMD", f"Redis unavailable: {e}")
+            group_ready = False
+            read_id = '0'
+            time.sleep(2)
+        except Exception as e:
+            print(f"❌ [CMD] Consumer Error: {e}")
+            time.sleep(1)
+
+def begin_transaction(code, user_id, user_name, txn_type):
+    """Register a door transaction for the monitor and fire the solenoid"""
+    with transaction_lock:
+        active_transactions[code] = {'user_id': user_id, 'start_time': clock(), 'type': txn_type, 'user_name': user_name}
+    set_locker_state(code, door='open', txn=txn_type, user_id=user_id, user_name=user_name)
+    if txn_type == 'booking':
+        record_booking(code)
+    return open_locker_hardware(code)
+
+def assign_locker(cursor, conn, user_id):
+    """
+    Return (locker_row, txn_type) for a known user: their current locker for
+    a release, or a newly booked free locker. (None, None) if the bank is full.
+    """
+    cursor.execute("SELECT * FROM lockers WHERE current_user_id = %s", (user_id,))
+    active_locker = cursor.fetchone()
+    if active_locker:
+        return active_locker, 'release'
+
+    resynced = False
+    failed = 0
+    while True:
+        code = free_index.pick() if free_index.loaded and failed < ALLOCATION_MAX_ATTEMPTS else None
+        if not code:
+            if resynced:
+                return None, None
+            # Index not up yet, empty or stale (frees done by another process): re-read the lockers table once
+            resynced = True
+            failed = 0
+            statuses = _read_locker_statuses(cursor)
+            if free_index.loaded:
+                free_index.sync_statuses(statuses)
+                code = free_index.pick()
+            else:
+                free_codes = [c for c in LOCKER_MAP if statuses.get(c) == 'available']
+                code = min(free_codes, key=lambda c: LOCKER_MAP[c]['id']) if free_codes else None
+            if not code:
+                return None, None
+        locker_id = LOCKER_MAP[code]['id']
+        # Update locker status (only if still free: the index may be stale)
+        cursor.execute("UPDATE lockers SET status = 'occupied', current_user_id = %s, occupied_at = %s WHERE id = %s AND status = 'available'", (user_id, db_now(), locker_id))
+        if cursor.rowcount == 1:
+            conn.commit()
+            # Log booking action with start_time (write-behind)
+            write_behind.enqueue({'op': 'usage_start', 'user_id': user_id, 'locker_id': locker_id, 'start_time': db_now()})
+            free_index.mark_occupied(code, booked=True)
+            log("LOGIC", f"Assigned: {code}")
+            return {'id': locker_id, 'locker_code': code, 'status': 'occupied', 'current_user_id': user_id}, 'booking'
+        free_index.mark_occupied(code)
+        failed += 1
+
+def process_tap(uid_hex):
+    """
+    Resolve a card and open its locker.
+    Returns (user, locker_row, txn_type); user is None for an unknown card,
+    locker_row is None when no locker is free. Raises IOError if the DB is down.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise IOError("database unavailable")
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM users WHERE card_uid = %s", (uid_hex,))
+        user = cursor.fetchone()
+        if not user:
+            record_tap('unknown')
+            return None, None, None
+
+        log("AUTH", f"User Identified: {user['name']}")
+        locker, txn_type = assign_locker(cursor, conn, user['id'])
+        record_tap(txn_type or 'full')
+        if locker:
+            log("LOGIC", f"Opening Locker {locker['locker_code']} for {txn_type.upper()}")
+            begin_transaction(locker['locker_code'], user['id'], user['name'], txn_type)
+        cursor.close()
+        return user, locker, txn_type
+    finally:
+        conn.close()
+
+def finish_transaction(code, txn):
+    """Door closed: complete the booking/release. Returns False if it must be retried."""
+    locker_db_id = LOCKER_MAP[code]['id']
+    duration = max(1, int(clock() - txn['start_time']) // 60)
+
+    # CHECK TRANSACTION TYPE
+    txn_type = txn.get('type', 'release') # Default to release if not set (fallback)
+
+    if txn_type == 'booking':
+        # Just finish transaction, keep locker OCCUPIED
+        log("DB", f"Locker {code} secured (BOOKING completed).")
+        set_locker_state(code, door='closed', txn=None)
+        # Send realtime notification for booking completed
+        send_realtime_notification(
+            event_type='locker_closed',
+            locker_id=locker_db_id,
+            locker_code=code,
+            user_id=txn['user_id'],
+            action='booking'
+        )
+
+    elif txn_type == 'admin':
+        # Remote open from the admin panel: nothing to write, just track the door
+        log("CMD", f"Locker {code} closed after admin open.")
+        set_locker_state(code, door='closed', txn=None)
+
+    elif txn_type == 'release':
+        # Free the locker
+        conn = get_db_connection()
+        if not conn:
+            return False
+        c = conn.cursor()
+        # Update locker status
+        c.execute("UPDATE lockers SET status = 'available', current_user_id = NULL, occupied_at = NULL WHERE id = %s", (locker_db_id,))
+        conn.commit()
+        conn.close()
+        # Log release action - Update existing entry with end_time (write-behind)
+        note = f"Duration: {duration} mins"
+        write_behind.enqueue({'op': 'usage_end', 'user_id': txn['user_id'], 'locker_id': locker_db_id,
+                              'end_time': db_now(), 'duration': duration, 'notes': note})
+        log("DB", f"Locker {code} freed. Duration: {duration}m")
+        free_index.mark_free(code)
+        if reader_channel:
+            # Multiprocess: bookings are allocated by the reader's own index
+            reader_channel.send(pack_msg(MSG_LOCKER_FREED, 0, locker_db_id, 0, code))
+        record_release(code)
+        set_locker_state(code, door='closed', txn=None, user_id=None, user_name=None)
+        # Send realtime notification for release completed
+        send_realtime_notification(
+            event_type='locker_closed',
+            locker_id=locker_db_id,
+            locker_code=code,
+            user_id=txn['user_id'],
+            action='release'
+        )
+
+    with transaction_lock: active_transactions.pop(code, None)
+    return True
+
+def reseed_open_transactions():
+    """
+    After a (bus) restart: track occupied lockers whose door is still open.
+    The original transaction type is unknown, so they are resumed as bookings;
+    a release that was in progress keeps the locker occupied and the user taps again.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise IOError("database unavailable")
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute("""
+            SELECT l.locker_code, l.current_user_id, u.name
+            FROM lockers l LEFT JOIN users u ON l.current_user_id = u.id
+            WHERE l.status = 'occupied'
+        """)
+        rows = c.fetchall()
+    finally:
+        conn.close()
+
+    resumed = []
+    for row in rows:
+        code = row['locker_code']
+        if code not in LOCKER_MAP or code in active_transactions:
+            continue
+        if read_locker_status(code) != 1:
+            continue
+        with transaction_lock:
+            active_transactions[code] = {'user_id': row['current_user_id'], 'start_time': clock(),
+                                         'type': 'booking', 'user_name': row['name']}
+        set_locker_state(code, door='open', txn='booking', user_id=row['current_user_id'], user_name=row['name'])
+        resumed.append(code)
+    if resumed:
+        log("BG", f"Resumed tracking open doors: {', '.join(resumed)}")
 
 # ==========================================
 # 2. BACKGROUND MONITOR
@@ -549,6 +2122,9 @@ def background_monitor():
     log("BG", "Monitor Thread Started")
     while True:
         try:
+            probe_open_slaves()
+            publish_bus_health()
+
             with transaction_lock:
                 codes = list(active_transactions.keys())
 
@@ -562,306 +2138,680 @@ def background_monitor():
                     txn = active_transactions[code]
 
                 status = read_locker_status(code)
-                locker_db_id = LOCKER_MAP[code]['id']
+                if status is None:
+                    # Slave unreachable or breaker open; other lockers keep polling
+                    continue
 
                 if status == -1: # Error
                     # ... stuck handling ...
+                    save_stuck_evidence(code)
+                    set_locker_state(code, door='stuck', txn=None)
                     with transaction_lock: del active_transactions[code]
                     continue
 
                 if status == 0: # Closed
-                    duration = max(1, int(time.time() - txn['start_time']) // 60)
-                    
-                    # CHECK TRANSACTION TYPE
-                    txn_type = txn.get('type', 'release') # Default to release if not set (fallback)
-                    
-                    if txn_type == 'booking':
-                         # Just finish transaction, keep locker OCCUPIED
-                         log("DB", f"Locker {code} secured (BOOKING completed).")
-                         # Send realtime notification for booking completed
-                         send_realtime_notification(
-                             event_type='locker_closed',
-                             locker_id=locker_db_id,
-                             locker_code=code,
-                             user_id=txn['user_id'],
-                             action='booking'
-                         )
-                         with transaction_lock: del active_transactions[code]
-                    
-                    elif txn_type == 'release':
-                        # Free the locker
-                        conn = get_db_connection()
-                        if conn:
-                            c = conn.cursor()
-                            # Update locker status
-                            c.execute("UPDATE lockers SET status = 'available', current_user_id = NULL, occupied_at = NULL WHERE id = %s", (locker_db_id,))
-                            # Log release action - Update existing entry with end_time
-                            note = f"Duration: {duration} mins"
-                            c.execute("UPDATE locker_usage SET end_time = NOW(), duration_minutes = %s, notes = %s WHERE user_id = %s AND locker_number = %s AND end_time IS NULL ORDER BY id DESC LIMIT 1", (duration, note, txn['user_id'], locker_db_id))
-                            conn.commit()
-                            conn.close()
-                            log("DB", f"Locker {code} freed. Duration: {duration}m")
-                            # Send realtime notification for release completed
-                            send_realtime_notification(
-                                event_type='locker_closed',
-                                locker_id=locker_db_id,
-                                locker_code=code,
-                                user_id=txn['user_id'],
-                                action='release'
-                            )
-                        with transaction_lock: del active_transactions[code]
-        except:
-             pass
+                    finish_transaction(code, txn)
+        except Exception as e:
+            print(f"❌ [BG] Monitor Error: {e}")
         time.sleep(0.5)
 
 # ==========================================
-# 3. MAIN LOOP
+# PAIRING SESSION (OTP)
 # ==========================================
-monitor_thread = threading.Thread(target=background_monitor, daemon=True)
-monitor_thread.start()
+# Saat kartu baru di-tap, seluruh sesi (user, OTP, UID sementara, TTL) dimuat
+# dalam satu pipeline Redis. OTP disimpan lokal sebagai hash dan diverifikasi
+# tanpa Redis saat mengetik. Salah OTP di-throttle dengan backoff; setelah
+# PAIRING_MAX_ATTEMPTS sesi dibatalkan. Cek kepemilikan kartu + UPDATE
+# dilakukan dalam satu statement (satu round trip DB).
+PAIRING_TTL = 120
+PAIRING_OTP_LENGTH = 6
+PAIRING_MAX_ATTEMPTS = 5
+PAIRING_THROTTLE_BASE = 2.0        # detik, digandakan tiap salah berikutnya
+PAIRING_REFRESH_INTERVAL = 2.0     # cek pembatalan dari web selama input OTP
+
+class PairingSession:
+    def __init__(self, user_id, otp, temp_uid, ttl):
+        self.user_id = user_id
+        self.salt = os.urandom(16)
+        self.otp_hash = self._hash(otp) if otp else None
+        self.temp_uid = temp_uid
+        # ttl: -1 = no expiry on the key, -2 = OTP missing (session unusable)
+        self.expires_at = time.time() + (PAIRING_TTL if ttl == -1 else max(0, ttl or 0))
+        self.failed_attempts = 0
+        self.locked_until = 0.0
+
+    def _hash(self, otp):
+        return hashlib.sha256(self.salt + otp.encode()).digest()
+
+    def verify(self, otp):
+        return self.otp_hash is not None and hmac.compare_digest(self._hash(otp), self.otp_hash)
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def throttle_remaining(self):
+        return max(0, self.locked_until - time.time())
+
+class PairingEngine:
+    def __init__(self):
+        self.session = None
+        self.last_refresh = 0.0
+
+    def poll(self):
+        """Return (pairing_user_id, pairing_status); no Redis traffic while an OTP session is live"""
+        now = time.time()
+        if self.session and not self.session.expired() and now - self.last_refresh < PAIRING_REFRESH_INTERVAL:
+            return self.session.user_id, 'waiting_otp'
+
+        if self.session and self.session.expired():
+            # OTP gone: end the session in Redis too, otherwise resume() would rebuild it every loop
+            log("PAIR", "Session expired")
+            self.finish('expired')
+            self.last_refresh = now
+            return None, None
+
+        user_id, status = r.mget('pairing_mode_active', 'pairing_status')
+        self.last_refresh = now
+        if self.session and (user_id != self.session.user_id or status != 'waiting_otp'):
+            log("PAIR", "Session ended (cancelled from web)")
+            self.session = None
+        return user_id, status
+
+    def start(self, user_id, uid_hex):
+        """Card tapped: store temp UID, move to OTP step and load the session in one round trip"""
+        pipe = r.pipeline(transaction=True)
+        pipe.set('pairing_temp_uid', uid_hex, ex=PAIRING_TTL)
+        pipe.set('pairing_status', 'waiting_otp', ex=PAIRING_TTL)
+        pipe.get('pairing_otp')
+        pipe.ttl('pairing_otp')
+        _, _, otp, ttl = pipe.execute()
+        self.session = PairingSession(user_id, otp, uid_hex, ttl)
+        self.last_refresh = time.time()
+
+    def resume(self, user_id):
+        """Rebuild a session already in waiting_otp (e.g. after a controller restart)"""
+        pipe = r.pipeline(transaction=False)
+        pipe.get('pairing_otp')
+        pipe.get('pairing_temp_uid')
+        pipe.ttl('pairing_otp')
+        otp, uid_hex, ttl = pipe.execute()
+        self.session = PairingSession(user_id, otp, uid_hex, ttl)
+        self.last_refresh = time.time()
+        if self.session.expired():
+            log("PAIR", "Session expired before OTP input")
+            self.finish('expired')
+
+    def finish(self, status):
+        """Publish the final status for the web page and close the session"""
+        pipe = r.pipeline(transaction=True)
+        pipe.set('pairing_status', status, ex=10) # Notify frontend
+        pipe.delete('pairing_mode_active', 'pairing_temp_uid')
+        pipe.execute()
+        self.session = None
+
+    def submit(self, otp):
+        """
+        Verify a complete OTP locally and link the card.
+        Returns 'success', 'wrong', 'locked', 'card_exists', 'expired', 'no_card' or 'db_error'.
+        """
+        session = self.session
+        if not session:
+            return 'expired'
+        if session.expired():
+            self.finish('expired')
+            return 'expired'
+        if not session.verify(otp):
+            session.failed_attempts += 1
+            if session.failed_attempts >= PAIRING_MAX_ATTEMPTS:
+                self.finish('otp_locked')
+                return 'locked'
+            if session.failed_attempts > 1:
+                session.locked_until = time.time() + PAIRING_THROTTLE_BASE * (2 ** (session.failed_attempts - 2))
+            return 'wrong'
+        if not session.temp_uid:
+            return 'no_card'
+
+        conn = get_db_connection()
+        if not conn:
+            return 'db_error'
+        try:
+            conn.autocommit = True
+            c = conn.cursor()
+            # Ownership check and link in one statement (derived table: MySQL
+            # cannot reference the UPDATE target directly in a subquery)
+            c.execute("""
+                UPDATE users SET card_uid = %s
+                WHERE id = %s AND NOT EXISTS (
+                    SELECT 1 FROM (SELECT id FROM users WHERE card_uid = %s AND id != %s) AS taken
+                )
+            """, (session.temp_uid, session.user_id, session.temp_uid, session.user_id))
+            linked = c.rowcount == 1
+        finally:
+            conn.close()
 
-print("\n🤖 ===========================================")
-print("🤖 SMART LOCKER SYSTEM ONLINE")
-print("🤖 Waiting for RFID Cards or Sync Requests...")
-print("🤖 ===========================================\n")
+        self.finish('success' if linked else 'card_exists')
+        return 'success' if linked else 'card_exists'
 
-# Show LCD idle screen at startup
-lcd_show_idle()
+pairing = PairingEngine()
 
-current_otp_input = ""
-last_key_press_time = 0
-lcd_idle_shown = True
+# ==========================================
+# 3. MAIN LOOP
+# ==========================================
+def run_controller_loop():
+    """RFID + keypad loop (tap path)"""
+    current_otp_input = ""
+    last_key_press_time = 0
+    lcd_idle_shown = True
 
-while True:
-    try:
-        # 1. CHECK REDIS FOR SYNC MODE
-        pairing_user_id = r.get('pairing_mode_active')
-        pairing_status = r.get('pairing_status') # 'waiting_tap' or 'waiting_otp'
+    while True:
+        try:
+            # 1. CHECK REDIS FOR SYNC MODE
+            # Redis is not on the tap path: while it is down, treat as "not pairing"
+            pairing_user_id, pairing_status = None, None
+            if component_ready('redis'):
+                try:
+                    pairing_user_id, pairing_status = pairing.poll() # 'waiting_tap' or 'waiting_otp'
+                except redis.exceptions.RedisError as e:
+                    log("PAIR", f"Redis unavailable, pairing check skipped: {e}")
         
-        if pairing_user_id:
-             # --- SYNC MODE ACTIVE ---
+            if pairing_user_id:
+                 # --- SYNC MODE ACTIVE ---
              
-             if pairing_status == 'waiting_tap':
-                 # Scan for card to link
-                 uid = pn532.read_passive_target(timeout=0.5)
-                 if uid:
-                     uid_hex = ''.join([format(i, '02x') for i in uid])
-                     log("PAIR", f"Card Tapped during pairing mode: {uid_hex}")
+                 if pairing_status == 'waiting_tap':
+                     # Scan for card to link
+                     uid = pn532.read_passive_target(timeout=0.5)
+                     if uid:
+                         uid_hex = ''.join([format(i, '02x') for i in uid])
+                         log("PAIR", f"Card Tapped during pairing mode: {uid_hex}")
                      
-                     # CEK: Apakah kartu ini sudah terdaftar ke user manapun?
-                     conn = get_db_connection()
-                     registered_user = None
-                     if conn:
-                         try:
-                             cursor = conn.cursor(dictionary=True)
-                             cursor.execute("SELECT * FROM users WHERE card_uid = %s", (uid_hex,))
-                             registered_user = cursor.fetchone()
-                         except Exception as e:
-                             log("PAIR", f"DB Error: {e}")
+                         # CEK: Apakah kartu ini sudah terdaftar ke user manapun?
+                         conn = get_db_connection()
+                         registered_user = None
+                         if conn:
+                             try:
+                                 cursor = conn.cursor(dictionary=True)
+                                 cursor.execute("SELECT * FROM users WHERE card_uid = %s", (uid_hex,))
+                                 registered_user = cursor.fetchone()
+                             except Exception as e:
+                                 log("PAIR", f"DB Error: {e}")
                      
-                     if registered_user:
-                         # KARTU SUDAH TERDAFTAR - Proses seperti normal operation (buka loker)
-                         log("PAIR", f"Card belongs to {registered_user['name']}, processing as normal operation")
-                         user_id = registered_user['id']
-                         
-                         cursor.execute("SELECT * FROM lockers WHERE current_user_id = %s", (user_id,))
-                         active_locker = cursor.fetchone()
-                         
-                         is_new_booking = False
-                         
-                         if not active_locker:
-                             cursor.execute("SELECT * FROM lockers WHERE status = 'available' LIMIT 1")
-                             new_locker = cursor.fetchone()
-                             if new_locker:
-                                 cursor.execute("UPDATE lockers SET status = 'occupied', current_user_id = %s, occupied_at = NOW() WHERE id = %s", (user_id, new_locker['id']))
-                                 cursor.execute("INSERT INTO locker_usage (user_id, locker_number, start_time) VALUES (%s, %s, NOW())", (user_id, new_locker['id']))
-                                 conn.commit()
-                                 active_locker = new_locker
-                                 is_new_booking = True
-                                 log("LOGIC", f"Assigned: {active_locker['locker_code']}")
+                         if registered_user:
+                             # KARTU SUDAH TERDAFTAR - Proses seperti normal operation (buka loker)
+                             log("PAIR", f"Card belongs to {registered_user['name']}, processing as normal operation")
+                             user_id = registered_user['id']
+                             active_locker, txn_type = assign_locker(cursor, conn, user_id)
+                             record_tap(txn_type or 'full')
                          
-                         if active_locker:
-                             code = active_locker['locker_code']
-                             txn_type = 'booking' if is_new_booking else 'release'
-                             log("LOGIC", f"Opening Locker {code} for {txn_type.upper()} (while pairing mode active)")
-                             with transaction_lock:
-                                 active_transactions[code] = {'user_id': user_id, 'start_time': time.time(), 'type': txn_type, 'user_name': registered_user['name']}
-                             lcd_stop_animation()
-                             lcd_show_locker_open(active_locker['id'])
-                             open_locker_hardware(code)
-                             send_realtime_notification(
-                                 event_type='locker_opened',
-                                 locker_id=active_locker['id'],
-                                 locker_code=code,
-                                 user_id=user_id,
-                                 user_name=registered_user['name'],
-                                 action=txn_type
-                             )
-                             time.sleep(3)
-                             lcd_show_idle()
+                             if active_locker:
+                                 code = active_locker['locker_code']
+                                 log("LOGIC", f"Opening Locker {code} for {txn_type.upper()} (while pairing mode active)")
+                                 begin_transaction(code, user_id, registered_user['name'], txn_type)
+                                 lcd_stop_animation()
+                                 lcd_show_locker_open(active_locker['id'])
+                                 send_realtime_notification(
+                                     event_type='locker_opened',
+                                     locker_id=active_locker['id'],
+                                     locker_code=code,
+                                     user_id=user_id,
+                                     user_name=registered_user['name'],
+                                     action=txn_type
+                                 )
+                                 time.sleep(3)
+                                 lcd_show_idle()
                          
-                         cursor.close()
-                         conn.close()
-                         # JANGAN masuk ke proses pairing, user lain yang sedang pairing tetap menunggu
-                         continue
-                     else:
-                         # KARTU BELUM TERDAFTAR - Masuk ke proses pairing
-                         if conn:
+                             cursor.close()
                              conn.close()
+                             # JANGAN masuk ke proses pairing, user lain yang sedang pairing tetap menunggu
+                             continue
+                         else:
+                             # KARTU BELUM TERDAFTAR - Masuk ke proses pairing
+                             if conn:
+                                 conn.close()
                          
-                         # Store temp UID and move to OTP step
-                         r.set('pairing_temp_uid', uid_hex, ex=120)
-                         r.set('pairing_status', 'waiting_otp', ex=120)
+                             # Store temp UID, move to OTP step and load the session
+                             pairing.start(pairing_user_id, uid_hex)
                          
-                         # Provide Feedback
-                         print("✅ [PAIR] New Card Detected. Waiting for OTP on Keypad...")
-                         current_otp_input = "" # Reset input
-                         lcd_show_otp_input("")  # Show OTP input screen
-
-             elif pairing_status == 'waiting_otp':
-                 # Read Keypad for OTP
-                 if keypad:
-                     keys = keypad.pressed_keys
-                     if keys:
-                         # Debounce
-                         if time.time() - last_key_press_time > 0.3:
-                            key = keys[0] # Take first key
-                            print(f"🎹 Key Pressed: {key}")
-                            last_key_press_time = time.time()
+                             # Provide Feedback
+                             print("✅ [PAIR] New Card Detected. Waiting for OTP on Keypad...")
+                             current_otp_input = "" # Reset input
+                             lcd_show_otp_input("")  # Show OTP input screen
+
+                 elif pairing_status == 'waiting_otp':
+                     if pairing.session is None:
+                         pairing.resume(pairing_user_id)
+                         current_otp_input = ""
+
+                     # Read Keypad for OTP
+                     if keypad:
+                         keys = keypad.pressed_keys
+                         if keys:
+                             # Debounce
+                             if time.time() - last_key_press_time > 0.3:
+                                key = keys[0] # Take first key
+                                print(f"🎹 Key Pressed: {'*' if key.isdigit() else key}")
+                                last_key_press_time = time.time()
+
+                                wait = pairing.session.throttle_remaining() if pairing.session else 0
+                                if wait > 0:
+                                    # Too many wrong attempts: ignore input until the lockout ends
+                                    lcd_write(" TERLALU BANYAK ", f" Tunggu {int(wait) + 1} dtk ".center(16))
+                                    current_otp_input = ""
                             
-                            if key.isdigit():
-                                current_otp_input += key
-                                print(f"📝 OTP Input: {current_otp_input}")
-                                lcd_show_otp_input(current_otp_input)  # Update LCD with OTP digits
+                                elif key.isdigit():
+                                    current_otp_input += key
+                                    print(f"📝 OTP Input: {'*' * len(current_otp_input)}")
+                                    lcd_show_otp_input(current_otp_input)  # Update LCD with OTP digits
                                 
-                                # Verify if length matches (6 digits)
-                                if len(current_otp_input) == 6:
-                                    required_otp = r.get('pairing_otp')
-                                    if current_otp_input == required_otp:
-                                        # SUCCESS!
-                                        uid_hex = r.get('pairing_temp_uid')
-                                        if uid_hex:
-                                            conn = get_db_connection()
-                                            if conn:
-                                                c = conn.cursor()
-                                                
-                                                # Check if card is already registered to another user
-                                                c.execute("SELECT id, name FROM users WHERE card_uid = %s AND id != %s", (uid_hex, pairing_user_id))
-                                                existing_user = c.fetchone()
-                                                
-                                                if existing_user:
-                                                    # Card already registered to another user
-                                                    conn.close()
-                                                    print(f"❌ [PAIR] FAILED! Card already registered to another user (ID: {existing_user[0]})")
-                                                    r.set('pairing_status', 'card_exists', ex=10) # Notify frontend
-                                                    r.delete('pairing_mode_active')
-                                                    lcd_stop_animation()
-                                                    lcd_write(" KARTU DITOLAK! ", "Sudah Terdaftar")
-                                                    time.sleep(3)
-                                                    lcd_show_idle()
-                                                    current_otp_input = ""
-                                                else:
-                                                    # Card is available, proceed with registration
-                                                    c.execute("UPDATE users SET card_uid = %s WHERE id = %s", (uid_hex, pairing_user_id))
-                                                    conn.commit()
-                                                    conn.close()
-                                                    
-                                                    r.set('pairing_status', 'success', ex=10) # Notify frontend
-                                                    r.delete('pairing_mode_active')
-                                                    print("✅ [PAIR] SUCCESS! Card Linked via OTP.")
-                                                    # Send realtime notification for card pairing
-                                                    send_realtime_notification(
-                                                        event_type='card_paired',
-                                                        user_id=pairing_user_id
-                                                    )
-                                                    lcd_show_otp_success()  # Show success on LCD
-                                                    time.sleep(2)
-                                                    lcd_show_idle()  # Return to idle
-                                                    current_otp_input = ""
+                                    # Verify if length matches (6 digits)
+                                    if len(current_otp_input) == PAIRING_OTP_LENGTH:
+                                        otp_input, current_otp_input = current_otp_input, ""
+                                        result = pairing.submit(otp_input)
+
+                                        if result == 'success':
+                                            print("✅ [PAIR] SUCCESS! Card Linked via OTP.")
+                                            # Send realtime notification for card pairing
+                                            send_realtime_notification(
+                                                event_type='card_paired',
+                                                user_id=pairing_user_id
+                                            )
+                                            lcd_show_otp_success()  # Show success on LCD
+                                            time.sleep(2)
+                                            lcd_show_idle()  # Return to idle
+                                        elif result == 'card_exists':
+                                            # Card already registered to another user
+                                            print("❌ [PAIR] FAILED! Card already registered to another user")
+                                            lcd_stop_animation()
+                                            lcd_write(" KARTU DITOLAK! ", "Sudah Terdaftar")
+                                            time.sleep(3)
+                                            lcd_show_idle()
+                                        elif result == 'wrong':
+                                            print("❌ [PAIR] WRONG OTP!")
+                                            lcd_show_otp_error()  # Show error on LCD (3 seconds)
+                                            lcd_show_otp_input("")  # Return to OTP input screen
+                                        elif result == 'locked':
+                                            print("❌ [PAIR] Too many wrong OTP attempts, session cancelled.")
+                                            lcd_stop_animation()
+                                            lcd_write("  SESI DIBATAL  ", " Terlalu banyak ")
+                                            time.sleep(3)
+                                            lcd_show_idle()
+                                        elif result == 'expired':
+                                            print("❌ [PAIR] Session expired.")
+                                            lcd_show_idle()
+                                        elif result == 'no_card':
+                                            print("❌ [PAIR] Error: No Temp UID found.")
                                         else:
-                                             print("❌ [PAIR] Error: No Temp UID found.")
-                                             current_otp_input = ""
-                                    else:
-                                        print("❌ [PAIR] WRONG OTP!")
-                                        lcd_show_otp_error()  # Show error on LCD (3 seconds)
-                                        lcd_show_otp_input("")  # Return to OTP input screen
-                                        current_otp_input = "" # Reset
+                                            print("❌ [PAIR] Database unavailable, try again.")
+                                            lcd_show_otp_input("")
                             
-                            elif key == 'C': # Clear
-                                current_otp_input = ""
-                                lcd_show_otp_input("")  # Clear LCD OTP display
-                                print("Cleared Input")
+                                elif key == 'C': # Clear
+                                    current_otp_input = ""
+                                    lcd_show_otp_input("")  # Clear LCD OTP display
+                                    print("Cleared Input")
 
-             # Don't run normal logic if in pairing mode
-             time.sleep(0.1)
-             continue
+                 # Don't run normal logic if in pairing mode
+                 time.sleep(0.1)
+                 continue
 
-        # 2. NORMAL OPERATION (If not pairing)
+            # 2. NORMAL OPERATION (If not pairing)
         
-        # Scan for card
-        uid = pn532.read_passive_target(timeout=0.5)
+            # Scan for card
+            uid = pn532.read_passive_target(timeout=0.5)
         
-        if uid:
-            uid_hex = ''.join([format(i, '02x') for i in uid])
-            log("RFID", f"Card Detected: {uid_hex}")
+            if uid:
+                uid_hex = ''.join([format(i, '02x') for i in uid])
+                log("RFID", f"Card Detected: {uid_hex}")
+
+                try:
+                    user, active_locker, txn_type = process_tap(uid_hex)
+                except IOError:
+                    time.sleep(1)
+                    continue
 
-            conn = get_db_connection()
-            if not conn:
-                time.sleep(1)
+                if user:
+                    user_id = user['id']
+                    if active_locker:
+                        code = active_locker['locker_code']
+                        lcd_show_locker_open(active_locker['id'])  # Show locker number on LCD
+                        # Send realtime notification for locker opened
+                        send_realtime_notification(
+                            event_type='locker_opened',
+                            locker_id=active_locker['id'],
+                            locker_code=code,
+                            user_id=user_id,
+                            user_name=user['name'],
+                            action=txn_type
+                        )
+                    
+                else:
+                    log("AUTH", "Unknown Card.")
+                    # Old pairing check removed in favor of Redis state check at top
+
+                time.sleep(3)
+                lcd_show_idle()  # Return to idle screen
+
+        except Exception as e:
+            print(f"❌ [MAIN] Error: {e}")
+            time.sleep(1)
+
+# ==========================================
+# 4. MULTI-PROCESS MODE
+# ==========================================
+# CONTROLLER_MODE=multiprocess: tap path (reader), I2C owner (bus), LCD
+# (display) dan HTTP notifier jalan di proses sendiri sehingga animasi LCD
+# dan request jaringan tidak berebut GIL dengan pembacaan kartu.
+# Antar proses memakai socketpair AF_UNIX/SOCK_SEQPACKET (batas pesan
+# terjaga) dengan format biner ringkas:
+#   header '!BBHI' = type, arg, locker_id, user_id  +  teks UTF-8 (field dipisah \x1f)
+MSG_HEADER = struct.Struct('!BBHI')
+MSG_MAX_SIZE = 512
+MSG_FIELD_SEP = '\x1f'
+
+MSG_OPEN = 1                # reader -> bus: arg=txn type, text=code|name
+MSG_DISPLAY_IDLE = 10
+MSG_DISPLAY_OPEN = 11       # locker_id
+MSG_DISPLAY_OTP = 12        # text=digits
+MSG_DISPLAY_OTP_ERROR = 13
+MSG_DISPLAY_OTP_SUCCESS = 14
+MSG_DISPLAY_TEXT = 15       # text=line1|line2
+MSG_DISPLAY_STOP = 16
+MSG_NOTIFY = 20             # arg=event type, text=code|name|action
+MSG_RELOAD_MAP = 30         # bus -> reader: LOCKER_MAP_FILE changed
+MSG_LOCKER_FREED = 31       # bus -> reader: locker_id, text=code
+
+TXN_TYPES = ('booking', 'release', 'admin')
+EVENT_TYPES = ('locker_opened', 'locker_closed', 'card_paired', 'stats_update')
+
+WORKER_RESTART_DELAY = 1.0
+WORKER_RESTART_MAX_DELAY = 30.0
+BUS_SEND_RETRY = 2.0
+
+def pack_msg(msg_type, arg=0, locker_id=0, user_id=0, *fields):
+    text = MSG_FIELD_SEP.join('' if f is None else str(f) for f in fields).encode('utf-8')
+    return MSG_HEADER.pack(msg_type, arg, int(locker_id or 0), int(user_id or 0)) + text[:MSG_MAX_SIZE - MSG_HEADER.size]
+
+def unpack_msg(data):
+    msg_type, arg, locker_id, user_id = MSG_HEADER.unpack_from(data)
+    text = data[MSG_HEADER.size:].decode('utf-8', errors='replace')
+    fields = text.split(MSG_FIELD_SEP) if text else []
+    return msg_type, arg, locker_id or None, user_id or None, fields
+
+class Channel:
+    """One-way message channel; both ends survive worker restarts (held by supervisor)"""
+
+    def __init__(self, name, lossy=True):
+        self.name = name
+        self.lossy = lossy
+        self.rx, self.tx = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    def send(self, data):
+        # Never block the sender: MSG_DONTWAIT per call (setblocking would
+        # change the shared file description for every process)
+        deadline = time.time() + (0 if self.lossy else BUS_SEND_RETRY)
+        while True:
+            try:
+                self.tx.send(data, socket.MSG_DONTWAIT)
+                return True
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    log("IPC", f"Channel {self.name} full, message dropped")
+                    return False
+                time.sleep(0.01)
+            except OSError as e:
+                log("IPC", f"Channel {self.name} send error: {e}")
+                return False
+
+    def recv(self):
+        return unpack_msg(self.rx.recv(MSG_MAX_SIZE))
+
+bus_channel = None
+reader_channel = None
+display_channel = None
+notify_channel = None
+
+def _proxy_display():
+    """Replace LCD calls in this process with messages to the display worker"""
+    global lcd_show_idle, lcd_show_locker_open, lcd_show_otp_input, lcd_show_otp_error
+    global lcd_show_otp_success, lcd_write, lcd_stop_animation
+    lcd_show_idle = lambda: display_channel.send(pack_msg(MSG_DISPLAY_IDLE))
+    lcd_show_locker_open = lambda locker_id: display_channel.send(pack_msg(MSG_DISPLAY_OPEN, 0, locker_id))
+    lcd_show_otp_input = lambda digits: display_channel.send(pack_msg(MSG_DISPLAY_OTP, 0, 0, 0, digits))
+    lcd_show_otp_error = lambda: display_channel.send(pack_msg(MSG_DISPLAY_OTP_ERROR))
+    lcd_show_otp_success = lambda: display_channel.send(pack_msg(MSG_DISPLAY_OTP_SUCCESS))
+    lcd_write = lambda line1="", line2="": display_channel.send(pack_msg(MSG_DISPLAY_TEXT, 0, 0, 0, line1, line2))
+    lcd_stop_animation = lambda: display_channel.send(pack_msg(MSG_DISPLAY_STOP))
+
+def _proxy_notifier():
+    """Replace HTTP notifications in this process with messages to the notifier worker"""
+    global send_realtime_notification
+
+    def send_realtime_notification(event_type, locker_id=None, locker_code=None, user_id=None, user_name=None, action=None):
+        event_idx = EVENT_TYPES.index(event_type) if event_type in EVENT_TYPES else 255
+        notify_channel.send(pack_msg(MSG_NOTIFY, event_idx, locker_id, user_id,
+                                     locker_code or '', user_name or '', action or '', event_type))
+
+def _proxy_bus():
+    """Reader side: hand door transactions to the bus worker instead of touching I2C"""
+    global begin_transaction
+
+    def begin_transaction(code, user_id, user_name, txn_type):
+        locker_id = LOCKER_MAP[code]['id']
+        return bus_channel.send(pack_msg(MSG_OPEN, TXN_TYPES.index(txn_type), locker_id, user_id, code, user_name or ''))
+
+def run_reader_worker():
+    _proxy_display()
+    _proxy_notifier()
+    _proxy_bus()
+
+    def _listen():
+        while True:
+            try:
+                msg_type, _arg, _locker_id, _user_id, fields = reader_channel.recv()
+                if msg_type == MSG_LOCKER_FREED and fields:
+                    free_index.mark_free(fields[0])
+                elif msg_type == MSG_RELOAD_MAP:
+                    removed = apply_locker_map(read_locker_map_file())
+                    log("CMD", f"LOCKER_MAP reloaded in reader ({len(LOCKER_MAP)} lockers, {len(removed)} removed)")
+            except Exception as e:
+                print(f"❌ [READER] Channel Error: {e}")
+                time.sleep(0.1)
+
+    threading.Thread(target=_listen, daemon=True).start()
+    lcd_show_idle()
+    run_controller_loop()
+
+def run_bus_worker():
+    _proxy_notifier()
+    local_begin = begin_transaction
+
+    def _listen():
+        while True:
+            try:
+                msg_type, arg, _locker_id, user_id, fields = bus_channel.recv()
+                if msg_type == MSG_OPEN and fields:
+                    code = fields[0]
+                    name = fields[1] if len(fields) > 1 and fields[1] else None
+                    if code in LOCKER_MAP:
+                        local_begin(code, user_id, name, TXN_TYPES[arg])
+                    else:
+                        # Reader booked from a map that was just reloaded
+                        print(f"⚠️ [BUS] Open request for unknown locker {code} ignored")
+            except Exception as e:
+                print(f"❌ [BUS] Channel Error: {e}")
+                time.sleep(0.1)
+
+    threading.Thread(target=_listen, daemon=True).start()
+    threading.Thread(target=command_consumer, daemon=True).start()
+    background_monitor()
+
+def run_display_worker():
+    # LCD comes up lazily; init_lcd() shows the idle screen once it is ready
+    while True:
+        msg_type, _arg, locker_id, _user_id, fields = display_channel.recv()
+        if msg_type == MSG_DISPLAY_IDLE:
+            lcd_show_idle()
+        elif msg_type == MSG_DISPLAY_OPEN:
+            lcd_show_locker_open(locker_id)
+        elif msg_type == MSG_DISPLAY_OTP:
+            lcd_show_otp_input(fields[0] if fields else "")
+        elif msg_type == MSG_DISPLAY_OTP_ERROR:
+            lcd_show_otp_error()
+        elif msg_type == MSG_DISPLAY_OTP_SUCCESS:
+            lcd_show_otp_success()
+        elif msg_type == MSG_DISPLAY_TEXT:
+            lcd_stop_animation()
+            lcd_write(*(fields + ["", ""])[:2])
+        elif msg_type == MSG_DISPLAY_STOP:
+            lcd_stop_animation()
+
+def run_notifier_worker():
+    session = requests.Session()
+    while True:
+        msg_type, arg, locker_id, user_id, fields = notify_channel.recv()
+        if msg_type != MSG_NOTIFY:
+            continue
+        code, name, action, event_type = (fields + ['', '', '', ''])[:4]
+        post_locker_event({
+            'eventType': EVENT_TYPES[arg] if arg < len(EVENT_TYPES) else event_type,
+            'lockerId': locker_id,
+            'lockerCode': code or None,
+            'userId': user_id,
+            'userName': name or None,
+            'action': action or None
+        }, session=session)
+
+WORKERS = {
+    'reader': run_reader_worker,
+    'bus': run_bus_worker,
+    'display': run_display_worker,
+    'notifier': run_notifier_worker,
+}
+
+def _exit_on_signal(signum, frame):
+    sys.exit(0)
+
+def _worker_main(name, target):
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    log("SUPERVISOR", f"Worker '{name}' started (pid {os.getpid()})")
+    bring_up(name)
+    try:
+        target()
+    finally:
+        flush_write_behind()
+
+def run_supervisor():
+    """Fork one process per worker and restart any that dies"""
+    global bus_channel, reader_channel, display_channel, notify_channel
+    bus_channel = Channel('bus', lossy=False)
+    reader_channel = Channel('reader', lossy=False)
+    display_channel = Channel('display')
+    notify_channel = Channel('notifier')
+
+    ctx = multiprocessing.get_context('fork')
+    processes = {}
+    restart_delay = {name: WORKER_RESTART_DELAY for name in WORKERS}
+    restart_at = {}
+
+    def _spawn(name):
+        p = ctx.Process(target=_worker_main, args=(name, WORKERS[name]), name=f"locker-{name}", daemon=True)
+        p.start()
+        processes[name] = (p, time.time())
+
+    def _shutdown(signum, frame):
+        print("🛑 [SUPERVISOR] Stopping workers...")
+        for p, _ in processes.values():
+            if p.is_alive():
+                p.terminate()
+        for p, _ in processes.values():
+            p.join(timeout=2)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    for name in WORKERS:
+        _spawn(name)
+
+    print("\n🤖 ===========================================")
+    print("🤖 SMART LOCKER SYSTEM ONLINE (multiprocess)")
+    print("🤖 Workers: " + ", ".join(WORKERS))
+    print("🤖 ===========================================\n")
+
+    while True:
+        now = time.time()
+        for name, (p, started) in list(processes.items()):
+            if p.is_alive():
+                # Reset backoff once a worker has stayed up for a while
+                if now - started > WORKER_RESTART_MAX_DELAY:
+                    restart_delay[name] = WORKER_RESTART_DELAY
                 continue
+            if name not in restart_at:
+                print(f"⚠️ [SUPERVISOR] Worker '{name}' died (exit {p.exitcode}), restarting in {restart_delay[name]:.0f}s")
+                if name == 'bus':
+                    print("⚠️ [SUPERVISOR] Open doors of occupied lockers are re-tracked when 'bus' restarts")
+                restart_at[name] = now + restart_delay[name]
+                restart_delay[name] = min(WORKER_RESTART_MAX_DELAY, restart_delay[name] * 2)
+            elif now >= restart_at[name]:
+                del restart_at[name]
+                _spawn(name)
+        time.sleep(0.5)
 
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM users WHERE card_uid = %s", (uid_hex,))
-            user = cursor.fetchone()
-
-            if user:
-                log("AUTH", f"User Identified: {user['name']}")
-                user_id = user['id']
-                cursor.execute("SELECT * FROM lockers WHERE current_user_id = %s", (user_id,))
-                active_locker = cursor.fetchone()
-                
-                is_new_booking = False
-
-                if not active_locker:
-                    cursor.execute("SELECT * FROM lockers WHERE status = 'available' LIMIT 1")
-                    new_locker = cursor.fetchone()
-                    if new_locker:
-                        # Update locker status
-                        cursor.execute("UPDATE lockers SET status = 'occupied', current_user_id = %s, occupied_at = NOW() WHERE id = %s", (user_id, new_locker['id']))
-                        # Log booking action with start_time
-                        cursor.execute("INSERT INTO locker_usage (user_id, locker_number, start_time) VALUES (%s, %s, NOW())", (user_id, new_locker['id']))
-                        conn.commit()
-                        active_locker = new_locker
-                        is_new_booking = True
-                        log("LOGIC", f"Assigned: {active_locker['locker_code']}")
-
-                if active_locker:
-                    code = active_locker['locker_code']
-                    txn_type = 'booking' if is_new_booking else 'release'
-                    log("LOGIC", f"Opening Locker {code} for {txn_type.upper()}")
-                    with transaction_lock:
-                        active_transactions[code] = {'user_id': user_id, 'start_time': time.time(), 'type': txn_type, 'user_name': user['name']}
-                    lcd_show_locker_open(active_locker['id'])  # Show locker number on LCD
-                    open_locker_hardware(code)
-                    # Send realtime notification for locker opened
-                    send_realtime_notification(
-                        event_type='locker_opened',
-                        locker_id=active_locker['id'],
-                        locker_code=code,
-                        user_id=user_id,
-                        user_name=user['name'],
-                        action=txn_type
-                    )
-                    
-            else:
-                log("AUTH", "Unknown Card.")
-                # Old pairing check removed in favor of Redis state check at top
+# ==========================================
+# 5. STARTUP
+# ==========================================
+register_component('i2c', init_i2c)
+register_component('rfid', init_rfid)
+register_component('redis', init_redis)
+register_component('db', init_db)
+register_component('live_state', load_live_state, requires=('redis', 'db'))
+register_component('aggregates', load_aggregates, requires=('redis', 'db'))
+register_component('allocator', load_free_index, requires=('db',))
+register_component('write_behind', load_write_behind, requires=('db',))
+register_component('open_transactions', reseed_open_transactions, requires=('i2c', 'db', 'live_state'))
+register_component('lcd', init_lcd, lazy=True)
+register_component('keypad', init_keypad, lazy=True)
+
+# role -> (komponen yang dinyalakan, komponen jalur tap yang harus siap dulu)
+ROLE_COMPONENTS = {
+    'main': (('i2c', 'rfid', 'redis', 'db', 'live_state', 'aggregates', 'allocator', 'write_behind', 'open_transactions', 'lcd', 'keypad'), ('rfid', 'i2c')),
+    'reader': (('rfid', 'redis', 'db', 'allocator', 'write_behind', 'keypad'), ('rfid',)),
+    'bus': (('i2c', 'redis', 'db', 'live_state', 'aggregates', 'write_behind', 'open_transactions'), ('i2c',)),
+    'display': (('db', 'lcd'), ()),
+    'notifier': ((), ()),
+}
 
-            cursor.close()
-            conn.close()
-            time.sleep(3)
-            lcd_show_idle()  # Return to idle screen
+def bring_up(role):
+    """Start this process's components in parallel; return once the tap path is ready"""
+    global PROCESS_ROLE
+    PROCESS_ROLE = role
+    names, tap_path = ROLE_COMPONENTS[role]
+    start_components(names)
+    wait_for_components(*tap_path)
+    start_components(names, lazy=True)
+    pending = [name for name in names if not component_ready(name)]
+    log("INIT", f"[{role}] Tap path ready in {time.time() - startup_time:.2f}s" + (f", still starting: {', '.join(pending)}" if pending else ""))
+
+if __name__ == '__main__':
+    if CONTROLLER_MODE == 'multiprocess':
+        run_supervisor()
+    else:
+        bring_up('main')
 
-    except Exception as e:
-        print(f"❌ [MAIN] Error: {e}")
-        time.sleep(1)
+        monitor_thread = threading.Thread(target=background_monitor, daemon=True)
+        monitor_thread.start()
+
+        command_thread = threading.Thread(target=command_consumer, daemon=True)
+        command_thread.start()
+
+        print("\n🤖 ===========================================")
+        print("🤖 SMART LOCKER SYSTEM ONLINE")
+        print("🤖 Waiting for RFID Cards or Sync Requests...")
+        print("🤖 ===========================================\n")
+
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+        try:
+            run_controller_loop()
+        except KeyboardInterrupt:
+            print("🛑 Stopping...")
+        finally:
+            flush_write_behind()
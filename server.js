@@ -5,6 +5,7 @@ const cors = require('cors');
 const bcrypt = require('bcryptjs');
 const helmet = require('helmet');
 const rateLimit = require('express-rate-limit');
+const crypto = require('crypto');
 require('dotenv').config();
 
 const { pool, testConnection } = require('./config/database');
@@ -1786,6 +1787,91 @@ app.get('/api/lockers', async (req, res) => {
     }
 });
 
+// Same script as LIVE_STATE_SET_LUA in main.py: '_version' is bumped atomically by every writer
+const LIVE_STATE_SET_LUA = `
+local v = redis.call('HINCRBY', KEYS[1], '_version', 1)
+if ARGV[2] == 'null' then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', 'code', ARGV[1], 'version', v, 'state', ARGV[2])
+return v
+`;
+
+// Reflect a web-side occupancy change in the controller's live state table
+async function updateLiveLockerState(lockerCode, changes) {
+    try {
+        const raw = await redisClient.hGet('locker_live_state', lockerCode);
+        if (!raw) return;
+        const previous = JSON.parse(raw);
+        const state = { ...previous, ...changes };
+        if (state.txn !== previous.txn) {
+            state.since = Math.floor(Date.now() / 1000);
+        }
+        await redisClient.eval(LIVE_STATE_SET_LUA, {
+            keys: ['locker_live_state', 'locker_state_changes'],
+            arguments: [lockerCode, JSON.stringify(state), '1000']
+        });
+    } catch (error) {
+        console.error('Error updating live locker state:', error);
+    }
+}
+
+// Same as record_release in main.py: close the occupancy session of a locker freed from the web
+async function recordAggregateRelease(lockerCode) {
+    try {
+        const startedAt = await redisClient.zScore('locker_agg:occupied', lockerCode);
+        const multi = redisClient.multi().zRem('locker_agg:occupied', lockerCode);
+        if (startedAt !== null) {
+            const dwell = Math.max(0, Math.floor(Date.now() / 1000 - startedAt));
+            multi.hIncrBy('locker_agg:occupancy_seconds', lockerCode, dwell)
+                .hIncrBy('locker_agg:occupancy_seconds', '_total', dwell)
+                .hIncrBy('locker_agg:sessions', lockerCode, 1)
+                .hIncrBy('locker_agg:sessions', '_total', 1);
+        }
+        await multi.exec();
+    } catch (error) {
+        console.error('Error updating usage aggregates:', error);
+    }
+}
+
+// Get live locker state published by the Raspberry Pi controller (no DB query)
+app.get('/api/lockers/live', async (req, res) => {
+    try {
+        const raw = await redisClient.hGetAll('locker_live_state');
+        const version = parseInt(raw._version) || 0;
+        delete raw._version;
+
+        const lockers = Object.entries(raw).map(([lockerCode, value]) => {
+            const state = JSON.parse(value);
+            return {
+                id: state.id,
+                lockerCode: lockerCode,
+                door: state.door,
+                currentUserId: state.user_id,
+                userName: state.user_name,
+                transaction: state.txn,
+                since: state.since ? new Date(state.since * 1000).toISOString() : null
+            };
+        }).sort((a, b) => a.id - b.id);
+
+        res.json({
+            success: true,
+            version: version,
+            lockers: lockers,
+            total: lockers.length
+        });
+
+    } catch (error) {
+        console.error('Error fetching live locker state:', error);
+        res.status(500).json({
+            success: false,
+            message: 'Terjadi kesalahan saat mengambil status loker'
+        });
+    }
+});
+
 // Release a locker
 app.post('/api/lockers/release', async (req, res) => {
     const { lockerId, userId } = req.body;
@@ -1825,6 +1911,9 @@ app.post('/api/lockers/release', async (req, res) => {
 
         console.log(`✅ Locker ${lockerId} released by user ${userId}`);
 
+        await updateLiveLockerState(lockers[0].locker_code, { user_id: null, user_name: null, txn: null });
+        await recordAggregateRelease(lockers[0].locker_code);
+
         // Emit real-time update to all connected clients
         emitLockerUpdate({
             lockerId: lockerId,
@@ -2680,6 +2769,142 @@ app.get('/api/admin/overtime-lockers', verifyToken, async (req, res) => {
     }
 });
 
+// ==================== REMOTE LOCKER COMMANDS (Raspberry Pi) ====================
+// Commands are queued on the 'locker_commands' Redis Stream and executed by the
+// controller (main.py). Results are stored under 'locker_cmd:<idempotencyKey>'.
+
+const LOCKER_COMMANDS = ['open_locker', 'open_range', 'set_maintenance', 'reload_map', 'telemetry'];
+
+// Queue a command for the locker controller
+app.post('/api/admin/locker-command', verifyToken, async (req, res) => {
+    const { command, args, idempotencyKey } = req.body;
+
+    try {
+        if (!command || !LOCKER_COMMANDS.includes(command)) {
+            return res.status(400).json({
+                success: false,
+                message: `Command tidak valid. Gunakan: ${LOCKER_COMMANDS.join(', ')}`
+            });
+        }
+
+        const key = idempotencyKey || crypto.randomUUID();
+        const messageId = await redisClient.xAdd('locker_commands', '*', {
+            command: command,
+            args: JSON.stringify(args || {}),
+            idempotency_key: key,
+            requested_by: String(req.admin.id)
+        });
+
+        console.log(`📨 Admin queued locker command: ${command} (${key})`);
+
+        res.json({
+            success: true,
+            message: 'Perintah dikirim ke controller',
+            idempotencyKey: key,
+            messageId: messageId
+        });
+
+    } catch (error) {
+        console.error('Error queueing locker command:', error);
+        res.status(500).json({
+            success: false,
+            message: 'Terjadi kesalahan saat mengirim perintah'
+        });
+    }
+});
+
+// Get the result of a queued command
+app.get('/api/admin/locker-command/:key', verifyToken, async (req, res) => {
+    try {
+        const result = await redisClient.hGetAll(`locker_cmd:${req.params.key}`);
+
+        if (!result.status) {
+            return res.json({
+                success: true,
+                status: 'queued'
+            });
+        }
+
+        res.json({
+            success: true,
+            status: result.status,
+            result: result.result ? JSON.parse(result.result) : null,
+            finishedAt: result.finished_at ? new Date(parseInt(result.finished_at) * 1000).toISOString() : null
+        });
+
+    } catch (error) {
+        console.error('Error fetching locker command result:', error);
+        res.status(500).json({
+            success: false,
+            message: 'Terjadi kesalahan saat mengambil status perintah'
+        });
+    }
+});
+
+// Usage aggregates maintained incrementally by the locker controller (Redis counters)
+app.get('/api/admin/usage-aggregates', verifyToken, async (req, res) => {
+    try {
+        const overtimeHours = parseInt(req.query.overtimeHours) || 24;
+        const now = Math.floor(Date.now() / 1000);
+        const today = new Date();
+        const dayKey = `${today.getFullYear()}${String(today.getMonth() + 1).padStart(2, '0')}${String(today.getDate()).padStart(2, '0')}`;
+
+        const [occupancy, sessions, taps, overtime] = await redisClient.multi()
+            .hGetAll('locker_agg:occupancy_seconds')
+            .hGetAll('locker_agg:sessions')
+            .hGetAll(`locker_agg:taps:${dayKey}`)
+            .zRangeByScoreWithScores('locker_agg:occupied', '-inf', now - overtimeHours * 3600)
+            .exec();
+
+        const lockers = Object.keys(sessions)
+            .filter(code => code !== '_total')
+            .map(code => {
+                const seconds = parseInt(occupancy[code]) || 0;
+                const count = parseInt(sessions[code]) || 0;
+                return {
+                    lockerCode: code,
+                    occupiedMinutes: Math.round(seconds / 60),
+                    sessions: count,
+                    avgDwellMinutes: count ? Math.round(seconds / count / 60) : 0
+                };
+            });
+
+        const totalSeconds = parseInt(occupancy._total) || 0;
+        const totalSessions = parseInt(sessions._total) || 0;
+
+        const hourlyTaps = Array.from({ length: 24 }, (_, hour) => {
+            const hh = String(hour).padStart(2, '0');
+            return {
+                hour: hour,
+                taps: parseInt(taps[hh]) || 0,
+                booking: parseInt(taps[`${hh}:booking`]) || 0,
+                release: parseInt(taps[`${hh}:release`]) || 0,
+                unknown: parseInt(taps[`${hh}:unknown`]) || 0
+            };
+        });
+
+        res.json({
+            success: true,
+            lockers: lockers,
+            avgDwellMinutes: totalSessions ? Math.round(totalSeconds / totalSessions / 60) : 0,
+            totalSessions: totalSessions,
+            hourlyTaps: hourlyTaps,
+            overtime: overtime.map(entry => ({
+                lockerCode: entry.value,
+                since: new Date(entry.score * 1000).toISOString(),
+                hours: Math.floor((now - entry.score) / 3600)
+            }))
+        });
+
+    } catch (error) {
+        console.error('Error fetching usage aggregates:', error);
+        res.status(500).json({
+            success: false,
+            message: 'Terjadi kesalahan saat mengambil statistik penggunaan'
+        });
+    }
+});
+
 // Admin takeover locker (confiscate items)
 app.post('/api/admin/takeover-locker', verifyToken, async (req, res) => {
     const { usageId, adminNote } = req.body;
@@ -2740,6 +2965,9 @@ app.post('/api/admin/takeover-locker', verifyToken, async (req, res) => {
 
         console.log(`📦 Admin took over Locker #${usage.locker_number} from user ${usage.user_name}`);
 
+        await updateLiveLockerState(usage.locker_code, { user_id: null, user_name: null, txn: null });
+        await recordAggregateRelease(usage.locker_code);
+
         // Emit real-time overtime update
         emitOvertimeUpdate({
             action: 'takeover',
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+workload.py - Generator beban untuk controller Smart Locker
+Membuat trace tap/tutup pintu (sintetis atau replay dari tabel locker_usage)
+lalu menjalankannya lewat logika booking/release di main.py dengan waktu
+dipercepat. Hardware (I2C, RFID, LCD) disimulasikan; database dan Redis asli
+dipakai, jadi jalankan terhadap database staging, BUKAN produksi.
+Jam controller mengikuti waktu simulasi, jadi start_time/end_time dan
+agregat berisi dwell simulasi. duration_minutes tetap berarti sama seperti
+di controller (lama pintu terbuka saat release). Loker yang masih dipakai
+di akhir run di-release lagi kecuali --keep-occupied.
+
+Contoh:
+    python workload.py synth --rate 600:15m,120:45m --dwell 90m --unknown-ratio 0.05 --speed 120
+    python workload.py replay --since 2025-08-18 --until 2025-08-19 --speed 600
+    python workload.py synth --rate 300:1h --dry-run
+"""
+
+import argparse
+import heapq
+import random
+import time
+from datetime import datetime
+
+import main as controller
+
+# ==========================================
+# TRACE
+# ==========================================
+# Satu trace = list (t_detik, uid_hex, dwell_detik), t relatif terhadap awal
+# trace. uid None = user terdaftar mana pun yang sedang tidak memegang loker.
+# Tap kedua (release) baru dijadwalkan dwell detik setelah booking berhasil;
+# dwell None = tidak pernah release selama trace. Pintu ditutup otomatis
+# door_open detik setelah tap yang membuka loker.
+
+def parse_duration(text):
+    """'90', '90s', '15m', '2h' -> seconds"""
+    text = text.strip().lower()
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+def parse_rates(text):
+    """'600:15m,120:45m' -> [(taps_per_hour, duration_seconds), ...]"""
+    phases = []
+    for part in text.split(','):
+        rate, _, duration = part.partition(':')
+        phases.append((float(rate), parse_duration(duration or '1h')))
+    return phases
+
+def fetch_card_users(limit=None):
+    conn = controller.get_db_connection()
+    if not conn:
+        raise SystemExit("❌ Database tidak bisa diakses")
+    c = conn.cursor()
+    query = "SELECT card_uid FROM users WHERE card_uid IS NOT NULL AND is_active = TRUE"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    c.execute(query)
+    uids = [row[0] for row in c.fetchall()]
+    conn.close()
+    return uids
+
+def random_uid(rng):
+    return ''.join(format(rng.randrange(256), '02x') for _ in range(4))
+
+def synth_trace(phases, dwell_mean, unknown_ratio, has_users, rng):
+    """Poisson arrivals per phase; a known user who gets a locker keeps it ~exp(dwell_mean)"""
+    trace = []
+    t = 0.0
+    phase_start = 0.0
+    for rate, duration in phases:
+        phase_end = phase_start + duration
+        t = phase_start
+        while rate > 0:
+            t += rng.expovariate(rate / 3600.0)
+            if t >= phase_end:
+                break
+            if not has_users or rng.random() < unknown_ratio:
+                trace.append((t, random_uid(rng), None))
+            else:
+                trace.append((t, None, max(60.0, rng.expovariate(1.0 / dwell_mean))))
+        phase_start = phase_end
+    return trace
+
+def replay_trace(since, until):
+    """Tap at start_time of every locker_usage row in [since, until), keeping its dwell"""
+    conn = controller.get_db_connection()
+    if not conn:
+        raise SystemExit("❌ Database tidak bisa diakses")
+    c = conn.cursor()
+    c.execute("""
+        SELECT lu.start_time, lu.end_time, u.card_uid
+        FROM locker_usage lu JOIN users u ON u.id = lu.user_id
+        WHERE u.card_uid IS NOT NULL AND lu.start_time >= %s AND lu.start_time < %s
+        ORDER BY lu.start_time
+    """, (since, until))
+    rows = c.fetchall()
+    conn.close()
+    if not rows:
+        return []
+
+    origin = rows[0][0]
+    return [((start_time - origin).total_seconds(), uid,
+             (end_time - start_time).total_seconds() if end_time else None)
+            for start_time, end_time, uid in rows]
+
+# ==========================================
+# SIMULATED HARDWARE & COUNTERS
+# ==========================================
+stats = {
+    'taps': 0, 'booking': 0, 'release': 0, 'unknown': 0, 'full': 0, 'db_down': 0, 'no_idle_user': 0,
+    'doors_opened': 0, 'doors_closed': 0, 'max_open_doors': 0,
+    'connections': 0, 'commits': 0, 'select': 0, 'insert': 0, 'update': 0, 'other_sql': 0,
+    'state_writes': 0, 'aggregate_updates': 0, 'notifications': 0,
+}
+tap_latencies = []
+
+class CountingCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def _count(self, sql):
+        verb = sql.lstrip().split(None, 1)[0].lower()
+        stats[verb if verb in ('select', 'insert', 'update') else 'other_sql'] += 1
+
+    def execute(self, sql, params=None, *args, **kwargs):
+        self._count(sql)
+        return self._cursor.execute(sql, params, *args, **kwargs)
+
+    def executemany(self, sql, seq_params, *args, **kwargs):
+        self._count(sql)
+        return self._cursor.executemany(sql, seq_params, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class CountingConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._conn.cursor(*args, **kwargs))
+
+    def commit(self):
+        stats['commits'] += 1
+        return self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+def install_simulation(publish_state):
+    real_get_db_connection = controller.get_db_connection
+
+    def get_db_connection():
+        conn = real_get_db_connection()
+        if conn:
+            stats['connections'] += 1
+            return CountingConnection(conn)
+        return None
+
+    def open_locker_hardware(locker_code):
+        stats['doors_opened'] += 1
+        return True
+
+    def send_realtime_notification(*args, **kwargs):
+        stats['notifications'] += 1
+
+    real_set_locker_state = controller.set_locker_state
+
+    def set_locker_state(locker_code, **changes):
+        stats['state_writes'] += 1
+        if publish_state:
+            real_set_locker_state(locker_code, **changes)
+
+    def counted(real):
+        def wrapper(*args, **kwargs):
+            stats['aggregate_updates'] += 1
+            if publish_state:
+                real(*args, **kwargs)
+        return wrapper
+
+    controller.get_db_connection = get_db_connection
+    controller.open_locker_hardware = open_locker_hardware
+    controller.send_realtime_notification = send_realtime_notification
+    controller.set_locker_state = set_locker_state
+    for name in ('record_tap', 'record_booking', 'record_release'):
+        setattr(controller, name, counted(getattr(controller, name)))
+    controller.DEBUG_MODE = False
+    # Allocate through the in-memory free index, as in production
+    controller.load_free_index()
+    # History rows go through the controller's write-behind queue, as in production,
+    # but with a journal of its own so a controller on this Pi never replays it
+    controller.PROCESS_ROLE = 'workload'
+    controller.load_write_behind()
+
+# ==========================================
+# DRIVER
+# ==========================================
+
+def tap(uid):
+    """One card tap through the controller; returns txn_type or None"""
+    stats['taps'] += 1
+    started = time.perf_counter()
+    try:
+        user, locker, txn_type = controller.process_tap(uid)
+    except IOError:
+        stats['db_down'] += 1
+        return None, None
+    tap_latencies.append(time.perf_counter() - started)
+
+    if not user:
+        stats['unknown'] += 1
+        return None, None
+    if not locker:
+        stats['full'] += 1
+        return 'full', None
+    stats[txn_type] += 1
+    stats['max_open_doors'] = max(stats['max_open_doors'], len(controller.active_transactions))
+    return txn_type, locker['locker_code']
+
+def close_door(code):
+    txn = controller.active_transactions.get(code)
+    if txn:
+        controller.finish_transaction(code, txn)
+        stats['doors_closed'] += 1
+
+def run(trace, users, speed, door_open, rng, release_at_end=True):
+    """
+    Replay trace through process_tap / finish_transaction; speed=0 runs flat out.
+    The controller's clock follows simulated time, so history rows, aggregates
+    and durations carry the simulated dwell, not the accelerated wall time.
+    """
+    events = [(t, i, 'arrive', (uid, dwell)) for i, (t, uid, dwell) in enumerate(trace)]
+    heapq.heapify(events)
+    seq = len(events)
+    holding = set()   # users holding a locker booked during this run
+    sim = {'t': 0.0}
+    origin = time.time()
+    controller.clock = lambda: origin + sim['t']
+    wall_start = time.time()
+
+    while events:
+        t, _, kind, data = heapq.heappop(events)
+        sim['t'] = t
+        if speed > 0:
+            delay = wall_start + t / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        if kind == 'arrive':
+            uid, dwell = data
+            if uid is None:
+                idle = [u for u in users if u not in holding]
+                if not idle:
+                    stats['no_idle_user'] += 1
+                    continue
+                uid = rng.choice(idle)
+            txn_type, code = tap(uid)
+            if txn_type == 'booking':
+                holding.add(uid)
+                if dwell is not None:
+                    # Release only for bookings that actually got a locker
+                    heapq.heappush(events, (t + dwell, seq, 'leave', uid))
+                    seq += 1
+        elif kind == 'leave':
+            txn_type, code = tap(data)
+            if txn_type == 'release':
+                holding.discard(data)
+            elif txn_type == 'booking':
+                # Locker was freed outside the run: this one is released at the end
+                holding.add(data)
+        elif kind == 'close':
+            close_door(data)
+            continue
+
+        if code:
+            close_at = t + door_open * rng.uniform(0.5, 1.5)
+            heapq.heappush(events, (close_at, seq, 'close', code))
+            seq += 1
+
+    if release_at_end and holding:
+        # Leave the staging bank as it was: release every locker this run still holds
+        for uid in sorted(holding):
+            sim['t'] += door_open
+            txn_type, code = tap(uid)
+            if code:
+                sim['t'] += door_open
+                close_door(code)
+        print(f"🧹 Released {len(holding)} lockers still held at the end of the run")
+
+    return time.time() - wall_start, sim['t']
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def print_report(span, elapsed):
+    print("=" * 50)
+    print("📊 WORKLOAD REPORT")
+    print("=" * 50)
+    print(f"Trace span     : {span / 3600:.2f} h simulated in {elapsed:.1f} s")
+    print(f"Taps           : {stats['taps']} (booking {stats['booking']}, release {stats['release']}, "
+          f"unknown {stats['unknown']}, full {stats['full']}, db down {stats['db_down']})"
+          + (f", {stats['no_idle_user']} arrivals without an idle user" if stats['no_idle_user'] else ""))
+    print(f"Doors          : opened {stats['doors_opened']}, closed {stats['doors_closed']}, "
+          f"max open at once {stats['max_open_doors']}")
+    print(f"DB             : {stats['connections']} connections, {stats['commits']} commits, "
+          f"{stats['select']} SELECT, {stats['insert']} INSERT, {stats['update']} UPDATE, {stats['other_sql']} other")
+    print(f"Redis          : {stats['state_writes']} live-state updates, {stats['aggregate_updates']} aggregate updates")
+    print(f"Notifications  : {stats['notifications']} (not sent)")
+    if tap_latencies:
+        print(f"Tap latency    : p50 {percentile(tap_latencies, 50) * 1000:.1f} ms, "
+              f"p95 {percentile(tap_latencies, 95) * 1000:.1f} ms, "
+              f"max {max(tap_latencies) * 1000:.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Locker workload generator")
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    synth = sub.add_parser('synth', help="synthetic Poisson arrivals")
+    synth.add_argument('--rate', default='300:1h', help="taps/hour per phase, e.g. 600:15m,120:45m")
+    synth.add_argument('--dwell', default='90m', help="mean time a locker is kept (default 90m)")
+    synth.add_argument('--unknown-ratio', type=float, default=0.05, help="fraction of taps with unregistered cards")
+    synth.add_argument('--users', type=int, default=None, help="limit number of card users drawn from DB")
+
+    replay = sub.add_parser('replay', help="replay locker_usage history")
+    replay.add_argument('--since', required=True, help="start date (YYYY-MM-DD[ HH:MM])")
+    replay.add_argument('--until', required=True, help="end date (YYYY-MM-DD[ HH:MM])")
+
+    for p in (synth, replay):
+        p.add_argument('--speed', type=float, default=60.0, help="time acceleration factor, 0 = as fast as possible")
+        p.add_argument('--door-open', default='8s', help="mean time a door stays open after a tap")
+        p.add_argument('--seed', type=int, default=None)
+        p.add_argument('--publish-state', action='store_true', help="also write live state and usage aggregates to Redis")
+        p.add_argument('--keep-occupied', action='store_true', help="don't release lockers still held when the trace ends")
+        p.add_argument('--dry-run', action='store_true', help="only build and summarize the trace")
+
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    users = []
+    if args.mode == 'synth':
+        users = fetch_card_users(args.users)
+        trace = synth_trace(parse_rates(args.rate), parse_duration(args.dwell),
+                            args.unknown_ratio, bool(users), rng)
+        print(f"🧪 Synthetic trace: {len(trace)} arrivals for {len(users)} card users")
+    else:
+        since = datetime.fromisoformat(args.since)
+        until = datetime.fromisoformat(args.until)
+        trace = replay_trace(since, until)
+        print(f"🔁 Replay trace: {len(trace)} bookings from locker_usage [{since} .. {until})")
+
+    if args.dry_run or not trace:
+        return
+
+    print(f"⚠️ Writing to database '{controller.db_config['database']}' at {controller.db_config['host']}")
+    install_simulation(args.publish_state)
+    elapsed, span = run(trace, users, args.speed, parse_duration(args.door_open), rng, not args.keep_occupied)
+    controller.flush_write_behind()
+    print_report(span, elapsed)
+
+if __name__ == "__main__":
+    main()